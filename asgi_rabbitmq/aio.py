@@ -0,0 +1,149 @@
+import asyncio
+import random
+from string import ascii_letters as ASCII
+
+from .core import (
+    GROUP_ADD,
+    GROUP_ADD_MANY,
+    GROUP_DISCARD,
+    GROUP_DISCARD_MANY,
+    NEW_CHANNEL,
+    RECEIVE,
+    RECEIVE_BATCH,
+    SEND,
+    SEND_MANY,
+    RabbitmqChannelLayer,
+)
+
+
+class RabbitmqAsyncChannelLayer(RabbitmqChannelLayer):
+    """
+    RabbitMQ channel layer with asyncio API.
+
+    Layer methods are coroutines.  Connection thread futures are
+    wrapped into asyncio futures, so event loop never waits for the
+    broker.  Requires Python 3.5 or newer.
+    """
+
+    async def call(self, f, *args, **kwargs):
+        """
+        Apply protocol method with its own AMQP channel.  Many methods
+        can be in progress from one event loop at the same time.
+        """
+
+        future = self.thread.pool_schedule(f, *args, **kwargs)
+        try:
+            return await self.wait(future)
+        except asyncio.CancelledError:
+            self.thread.cancel(future)
+            if f in (RECEIVE, RECEIVE_BATCH):
+                # Messages received after the caller has gone are
+                # acknowledged already.  Send them back.
+                loop = asyncio.get_event_loop()
+                future.add_done_callback(
+                    lambda future: loop.call_soon_threadsafe(
+                        self.requeue, future),
+                )
+            raise
+
+    def requeue(self, future):
+        """Send messages of the cancelled receive to their channels."""
+
+        if future.exception() is not None:
+            return
+        result = future.result()
+        for channel, body in result if isinstance(result, list) else [result]:
+            if channel is not None:
+                self.thread.pool_schedule(SEND, channel, body)
+
+    async def wait(self, future):
+        """
+        Wait for the connection thread future.  It is resolved by the
+        connection thread only.  Cancellation of the caller must not
+        touch it.
+        """
+
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    async def send(self, channel, message, timeout=None):
+        """Send the message to the channel."""
+
+        # Messages are published in order with AMQP channel of the
+        # event loop thread.
+        future = self.send_async(channel, message, timeout=timeout)
+        return await self.wait(future)
+
+    async def send_many(self, pairs, timeout=None):
+        """Send many messages in one pass."""
+
+        batch = []
+        for channel, message in pairs:
+            fail_msg = 'Channel name %s is not valid' % channel
+            assert self.valid_channel_name(channel), fail_msg
+            batch.append((channel, self.serialize(message)))
+        if not batch:
+            return []
+        future = self.thread.schedule(SEND_MANY, batch, timeout=timeout)
+        return await self.wait(future)
+
+    async def receive(self, channels, block=False, timeout=None):
+        """Receive one message from one of the channels."""
+
+        for channel in channels:
+            fail_msg = 'Channel name %s is not valid' % channel
+            assert self.valid_channel_name(channel, receive=True), fail_msg
+        result = await self.call(RECEIVE, channels, block, timeout=timeout)
+        return self.received(result)
+
+    async def receive_batch(self, channels, max_messages=10, timeout=None):
+        """Receive up to `max_messages` messages in one pass."""
+
+        for channel in channels:
+            fail_msg = 'Channel name %s is not valid' % channel
+            assert self.valid_channel_name(channel, receive=True), fail_msg
+        result = await self.call(RECEIVE_BATCH, channels, max_messages,
+                                 timeout, timeout=timeout)
+        return [self.received(message) for message in result]
+
+    async def new_channel(self, pattern, timeout=None):
+        """Create new single reader channel."""
+
+        assert pattern.endswith('?')
+        random_string = "".join(random.choice(ASCII) for i in range(20))
+        new_name = pattern + random_string
+        await self.call(NEW_CHANNEL, new_name, timeout=timeout)
+        return new_name
+
+    async def group_add(self, group, channel, timeout=None):
+        """Add channel to the group."""
+
+        assert self.valid_group_name(group), 'Group name is not valid'
+        assert self.valid_channel_name(channel), 'Channel name is not valid'
+        return await self.call(GROUP_ADD, group, channel, timeout=timeout)
+
+    async def group_discard(self, group, channel, timeout=None):
+        """Remove the channel from the group."""
+
+        assert self.valid_group_name(group), 'Group name is not valid'
+        assert self.valid_channel_name(channel), 'Channel name is not valid'
+        return await self.call(GROUP_DISCARD, group, channel,
+                               timeout=timeout)
+
+    async def group_add_many(self, pairs, timeout=None):
+        """Add channels to groups in one pass."""
+
+        memberships = self.memberships(pairs)
+        return await self.call(GROUP_ADD_MANY, memberships, timeout=timeout)
+
+    async def group_discard_many(self, pairs, timeout=None):
+        """Remove channels from groups in one pass."""
+
+        memberships = self.memberships(pairs)
+        return await self.call(GROUP_DISCARD_MANY, memberships,
+                               timeout=timeout)
+
+    async def send_group(self, group, message, timeout=None):
+        """Send the message to the group."""
+
+        future = self.send_group_async(group, message, timeout=timeout)
+        return await self.wait(future)
@@ -1,6 +1,11 @@
 import base64
 import hashlib
+import math
 import random
+import socket
+import time
+import uuid
+from collections import OrderedDict, deque, namedtuple
 from functools import partial
 from string import ascii_letters as ASCII
 
@@ -8,9 +13,10 @@ import msgpack
 from asgiref.base_layer import BaseChannelLayer
 from cached_property import threaded_cached_property
 from pika import SelectConnection, URLParameters
+from pika.adapters.select_connection import READ
 from pika.channel import Channel
 from pika.exceptions import ChannelClosed, ConnectionClosed
-from pika.spec import Basic, BasicProperties
+from pika.spec import Basic, BasicProperties, Queue
 
 try:
     from concurrent.futures import Future
@@ -22,6 +28,11 @@ try:
 except ImportError:
     from threading import Thread, Lock, Event, _get_ident as get_ident
 
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 try:
     from twisted.internet import defer, reactor
     TWISTED_AVAILABLE = True
@@ -37,6 +48,310 @@ SEND_GROUP = 5
 DECLARE_DEAD_LETTERS = 6
 EXPIRE_GROUP_MEMBER = 7
 RECEIVE_TWISTED = 8
+SEND_MANY = 9
+SEND_CHUNKS = 10
+RECEIVE_BATCH = 11
+GROUP_ADD_MANY = 12
+GROUP_DISCARD_MANY = 13
+
+# Group discard removes a binding for each live expiry bucket.
+MAX_EXPIRY_BUCKETS = 60
+
+
+def serialize(message, crypter=None):
+    """Pack message with msgpack.  Encrypt it if `crypter` is given."""
+
+    value = msgpack.packb(message, use_bin_type=True)
+    if crypter:
+        value = crypter.encrypt(value)
+    return value
+
+
+def deserialize(message, crypter=None, expiry=None):
+    """
+    Decrypt message if `crypter` is given.  Encrypted token older than
+    `expiry` with a small margin is rejected.  Unpack it with msgpack.
+    """
+
+    if crypter:
+        message = crypter.decrypt(message, expiry + 10)
+    return msgpack.unpackb(message, raw=False)
+
+
+class ExpiringCache(object):
+    """
+    Bounded mapping with optional time to live for each key.  Oldest
+    keys are evicted first when size limit is reached.  Isn't thread
+    safe.
+    """
+
+    def __init__(self, maxsize):
+
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        """Get stored value unless it was expired."""
+
+        try:
+            deadline, value = self.data[key]
+        except KeyError:
+            return default
+        if deadline is not None and deadline <= monotonic():
+            del self.data[key]
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store value for `ttl` seconds or forever."""
+
+        self.data.pop(key, None)
+        if len(self.data) >= self.maxsize:
+            self.data.popitem(last=False)
+        deadline = None if ttl is None else monotonic() + ttl
+        self.data[key] = (deadline, value)
+
+    def replace(self, key, value):
+        """Change stored value.  Keep its expiration time."""
+
+        deadline, _ = self.data[key]
+        self.data[key] = (deadline, value)
+
+    def discard(self, key):
+        """Forget the key if it is present."""
+
+        self.data.pop(key, None)
+
+    def clear(self):
+        """Forget all keys."""
+
+        self.data.clear()
+
+
+class Topology(object):
+    """
+    Queues and exchanges known to be declared through the connection.
+
+    Allows protocol instances to skip declare round trip before
+    publish and receive.  Stored queue value is the number of messages
+    in the queue we know about.  Bindings are group members added
+    recently by the pipelined group add together with their expiry
+    bucket.  Refreshed are group members
+    added within the refresh window.  Empty groups are group exchanges
+    which returned recent message without routing it.
+    """
+
+    size = 4096
+    """Maximum number of the queues and exchanges to remember."""
+
+    def __init__(self):
+
+        self.queues = ExpiringCache(self.size)
+        self.exchanges = ExpiringCache(self.size)
+        self.bindings = ExpiringCache(self.size)
+        self.refreshed = ExpiringCache(self.size)
+        self.empty_groups = ExpiringCache(self.size)
+
+    def queue_ttl(self, arguments):
+        """
+        Time to remember declared queue.  Publishing doesn't renew queue
+        lease on the broker side.  So we redeclare queue when half of
+        `x-expires` time is gone.
+        """
+
+        return arguments['x-expires'] / 2000.0
+
+    def discard_membership(self, group, channel):
+        """Forget the member removed from the group."""
+
+        for key in list(self.bindings.data):
+            if key[:2] == (group, channel):
+                self.bindings.discard(key)
+        self.refreshed.discard((group, channel))
+
+    def discard_member(self, channel):
+        """Forget group bindings of the deleted channel."""
+
+        for cache in (self.bindings, self.refreshed):
+            for key in list(cache.data):
+                if key[1] == channel:
+                    cache.discard(key)
+
+    def invalidate(self):
+        """Forget everything.  Broker state may differ from what we know."""
+
+        self.queues.clear()
+        self.exchanges.clear()
+        self.bindings.clear()
+        self.refreshed.clear()
+        self.empty_groups.clear()
+
+
+ChannelName = namedtuple('ChannelName', ['queue', 'capacity', 'remote'])
+
+
+class ChannelNames(object):
+    """
+    Memoized channel name properties: RabbitMQ queue name, channel
+    capacity and if channel is process local or single reader one.
+    Least recently used names are evicted first.  Shared between
+    protocol instances and the layer, so it is thread safe.
+    """
+
+    size = 4096
+    """Maximum number of channel names to remember."""
+
+    def __init__(self, get_capacity):
+
+        self.get_capacity = get_capacity
+        self.names = OrderedDict()
+        self.lock = Lock()
+
+    def lookup(self, channel):
+        """Get properties of the channel name."""
+
+        with self.lock:
+            name = self.names.pop(channel, None)
+            if name is not None:
+                self.names[channel] = name
+                return name
+        if '!' in channel:
+            queue = channel[:channel.rfind('!') + 1]
+        else:
+            queue = channel
+        remote = '!' in channel or '?' in channel
+        name = ChannelName(queue, self.get_capacity(channel), remote)
+        with self.lock:
+            self.names[channel] = name
+            if len(self.names) > self.size:
+                self.names.popitem(last=False)
+        return name
+
+    def queue(self, channel):
+        """Translate ASGI channel name to the RabbitMQ queue name."""
+
+        return self.lookup(channel).queue
+
+    def capacity(self, channel):
+        """Channel capacity."""
+
+        return self.lookup(channel).capacity
+
+    def is_remote(self, channel):
+        """Check if channel is a process local or a single reader one."""
+
+        return self.lookup(channel).remote
+
+
+class Chunks(object):
+    """
+    Reassembly buffer for messages sent in chunks.  Chunks of one
+    message can be received by different threads, so buffer is shared
+    between protocol instances of the connection.  Partially received
+    messages are dropped when they expire or buffer is full.
+    """
+
+    size = 256
+    """Maximum number of partially received messages to hold."""
+
+    def __init__(self):
+
+        self.messages = ExpiringCache(self.size)
+
+    def add(self, message_id, index, total, body, ttl):
+        """
+        Store one chunk of the message.  Return whole message body if it
+        was the last missing chunk.
+        """
+
+        chunks = self.messages.get(message_id)
+        if chunks is None:
+            chunks = {}
+            self.messages.set(message_id, chunks, ttl=ttl)
+        chunks[index] = body
+        if len(chunks) < total:
+            return None
+        self.messages.discard(message_id)
+        return b''.join(chunks[number] for number in range(total))
+
+
+class ReceiveScheduler(object):
+    """
+    Choose which channel receive should return message from when many
+    channels have messages.  Holds state between receive calls of one
+    thread.  Policies are:
+
+    * ``ordered`` first channel in the receive argument order
+    * ``round-robin`` next channel after the previously chosen one
+    * ``weighted`` smooth weighted round robin by channel priority
+    * ``priority`` channel with the highest priority
+    """
+
+    policies = ('ordered', 'round-robin', 'weighted', 'priority')
+    """Known policy names."""
+
+    size = 1024
+    """Maximum number of channels to remember weighted state for."""
+
+    def __init__(self, policy='ordered', priorities=()):
+
+        self.policy = getattr(self, policy.replace('-', '_'))
+        self.priorities = priorities
+        self.last = None
+        self.current = {}
+
+    def choose(self, channels, candidates):
+        """
+        Choose one of the `candidates` channels.  `channels` is the
+        receive argument.  Candidates are in the same order.
+        """
+
+        return self.policy(list(channels), candidates)
+
+    def weight(self, channel):
+        """Channel priority.  Channels without priority have 1."""
+
+        for pattern, value in self.priorities:
+            if pattern.match(channel):
+                return value
+        return 1
+
+    def ordered(self, channels, candidates):
+
+        return candidates[0]
+
+    def round_robin(self, channels, candidates):
+
+        if self.last in channels:
+            start = channels.index(self.last) + 1
+            channels = channels[start:] + channels[:start]
+        for channel in channels:
+            if channel in candidates:
+                self.last = channel
+                return channel
+
+    def weighted(self, channels, candidates):
+
+        if len(self.current) > self.size:
+            self.current.clear()
+        total = 0
+        chosen = None
+        for channel in candidates:
+            weight = self.weight(channel)
+            self.current[channel] = self.current.get(channel, 0) + weight
+            total += weight
+            if chosen is None or self.current[channel] > self.current[chosen]:
+                chosen = channel
+        self.current[chosen] -= total
+        return chosen
+
+    def priority(self, channels, candidates):
+
+        return max(candidates, key=self.weight)
 
 
 class Protocol(object):
@@ -45,13 +360,121 @@ class Protocol(object):
     dead_letters = 'dead-letters'
     """Name of the protocol dead letters exchange and queue."""
 
-    def __init__(self, expiry, group_expiry, get_capacity, crypter, resolve):
+    direct_groups = 'groups'
+    """Name of the exchange shared by all groups in direct routing."""
+
+    def __init__(self, expiry, group_expiry, get_capacity, crypter, resolve,
+                 topology=None, names=None, chunks=None,
+                 broker_capacity=False, publisher_confirms=False,
+                 prefetch_count=None, ack_policy='immediate', ack_batch=10,
+                 ack_interval=0.1, receive_policy='ordered',
+                 channel_priority=(), pipeline_group_add=False,
+                 empty_group_ttl=None, group_expiry_buckets=None,
+                 group_refresh_window=None, direct_local_groups=False,
+                 group_routing='exchange', queue_length_cache=False):
 
         self.expiry = expiry
         self.group_expiry = group_expiry
         self.get_capacity = get_capacity
         self.crypter = crypter
         self.resolve = resolve
+        self.topology = topology if topology is not None else Topology()
+        self.names = names if names is not None else ChannelNames(
+            get_capacity)
+        self.chunks = chunks if chunks is not None else Chunks()
+        # AMQP channel will be assigned when it will be opened.  Methods
+        # scheduled before this moment are stored in the backlog.
+        self.amqp_channel = None
+        self.backlog = []
+        # Futures of the methods in progress.  Thread can schedule next
+        # method without waiting for the previous one.
+        self.pending = set()
+        self.broker_capacity = broker_capacity
+        # Trust queue length we remember instead of asking broker before
+        # each publish.  Other producers can overshoot channel capacity.
+        self.queue_length_cache = queue_length_cache
+        # Publisher confirms state.  Delivery tag of the last published
+        # message and futures waiting for its confirmation together
+        # with error for rejected message.  Broker capacity can't work
+        # without confirms.
+        self.confirm_delivery = publisher_confirms or broker_capacity
+        self.delivery_tag = 0
+        self.unconfirmed = {}
+        # Persistent consumers state.  Channels we consume and their
+        # consumer tags, messages delivered but not received by the
+        # thread yet and the future of the blocking receive waiting
+        # for the next delivery.
+        self.prefetch_count = prefetch_count
+        self.consumers = {}
+        # Channels of the last blocking receive in the caller order.
+        # Receive scheduler needs it to choose from the inbox.
+        self.receiving = []
+        self.inbox = deque()
+        self.receiver = None
+        # Parallel consumers of the blocking receive in progress by its
+        # future.  Receive methods which can be stopped on timeout
+        # without breaking AMQP channel state.
+        self.blocking = {}
+        self.cancellable = {}
+        # AMQP channel state is unknown after operation timeout.  It
+        # will be closed and never used again.
+        self.poisoned = False
+        # Acknowledgment policy.  In the coalesced mode we remember
+        # delivery tags of received messages and acknowledge them
+        # together on batch size or timer.
+        self.ack_policy = ack_policy
+        self.no_ack = ack_policy == 'none'
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+        self.ack_tags = []
+        self.ack_timer = None
+        # Delivery tags of get replies held by receive in progress.
+        # They will be rejected or acknowledged later.
+        self.held = set()
+        # Each thread rotates over its channels independently.
+        self.scheduler = ReceiveScheduler(receive_policy, channel_priority)
+        self.pipeline_group_add = pipeline_group_add
+        # Group messages are published as mandatory to detect groups
+        # without members.  Sends to them are skipped for a while.
+        self.empty_group_ttl = empty_group_ttl
+        # Message properties and queue arguments computed once.  Pika
+        # doesn't change them, so they are shared between calls.
+        # Channel queue arguments are stored by channel capacity and
+        # process queue flag.
+        self.properties = BasicProperties(expiration=str(expiry * 1000))
+        self.channel_arguments = {}
+        self.member_arguments = {
+            'x-dead-letter-exchange': self.dead_letters,
+            'x-expires': group_expiry * 1000,
+            'x-max-length': 0,
+        }
+        self.marker_arguments = {
+            'x-dead-letter-exchange': self.dead_letters,
+            'x-max-length': 1,
+            'x-message-ttl': group_expiry * 1000,
+            # Give broker some time to expire message before expire
+            # whole queue.
+            'x-expires': group_expiry * 1000 + 25,
+        }
+        # Bucketed group expiry.  Markers of all memberships expiring
+        # in the same time interval are stored in one queue.  Bucket
+        # queue lives until its last marker expires.
+        # Groups are fanout exchanges with intermediate exchange for
+        # each member or routing keys of the shared direct exchange.
+        self.group_routing = group_routing
+        # Process local members dead letter group messages straight
+        # into the process queue instead of the dead letters exchange.
+        self.direct_local_groups = direct_local_groups
+        # Members added within this window are not added again.
+        self.group_refresh_window = group_refresh_window
+        self.group_expiry_buckets = group_expiry_buckets
+        if group_expiry_buckets:
+            self.bucket_interval = float(group_expiry) / group_expiry_buckets
+            self.bucket_arguments = {
+                'x-dead-letter-exchange': self.dead_letters,
+                'x-expires': int(
+                    (group_expiry + 2 * self.bucket_interval) * 1000),
+            }
         # Mapping for the connection schedule method.
         self.methods = {
             SEND: self.send,
@@ -63,6 +486,11 @@ class Protocol(object):
             DECLARE_DEAD_LETTERS: self.declare_dead_letters,
             EXPIRE_GROUP_MEMBER: self.expire_group_member,
             RECEIVE_TWISTED: self.receive_twisted,
+            SEND_MANY: self.send_many,
+            SEND_CHUNKS: self.send_chunks,
+            RECEIVE_BATCH: self.receive_batch,
+            GROUP_ADD_MANY: self.group_add_many,
+            GROUP_DISCARD_MANY: self.group_discard_many,
         }
 
     # Utilities.
@@ -74,11 +502,25 @@ class Protocol(object):
         """
 
         self.amqp_channel = amqp_channel
+        if self.poisoned:
+            # Methods waiting for this channel were timed out.
+            amqp_channel.close()
+            return
+        if self.confirm_delivery:
+            amqp_channel.confirm_delivery(self.on_confirmation, nowait=True)
+        if self.empty_group_ttl:
+            amqp_channel.add_on_return_callback(self.on_return)
         self.apply(*method)
+        backlog, self.backlog = self.backlog, []
+        for method, future in backlog:
+            self.resolve = future
+            self.apply(*method)
 
     def apply(self, method_id, args, kwargs):
         """Take method from the mapping and call it."""
 
+        self.pending.add(self.resolve)
+        self.resolve.add_done_callback(self.pending.discard)
         self.methods[method_id](*args, **kwargs)
 
     def protocol_error(self, error):
@@ -87,93 +529,446 @@ class Protocol(object):
         thread.
         """
 
-        self.resolve.set_exception(error)
+        # Methods in progress and messages published in the confirm
+        # mode will never be finished at this point.
+        futures = set(self.pending)
+        futures.add(self.resolve)
+        futures.update(future for future, _ in self.unconfirmed.values())
+        futures.update(future for _, future in self.backlog)
+        self.unconfirmed = {}
+        self.backlog = []
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def expire(self, future):
+        """
+        Scheduled method wasn't finished in time.  Blocking receive
+        returns empty response.  Any other method leaves AMQP channel in
+        the unknown state, so we close it and fail all methods in
+        progress.
+        """
+
+        if self.cancel(future):
+            return
+        self.poisoned = True
+        if self.amqp_channel is not None and self.amqp_channel.is_open:
+            self.amqp_channel.close()
+        self.protocol_error(RabbitmqChannelLayer.Timeout())
+
+    def cancel(self, future):
+        """
+        Stop waiting receive without breaking AMQP channel state.  It
+        returns empty response.  Return `False` if the method can't be
+        stopped.
+        """
+
+        if future is self.receiver:
+            self.receiver = None
+            future.set_result((None, None))
+            return True
+        on_timeout = self.cancellable.pop(future, None)
+        if on_timeout is not None:
+            on_timeout()
+            return True
+        return False
 
     def get_queue_name(self, channel):
         """Translate ASGI channel name to the RabbitMQ queue name."""
 
-        if '!' in channel:
-            return channel[:channel.rfind('!') + 1]
-        else:
-            return channel
+        return self.names.queue(channel)
+
+    def declare_queues(self, callback, queues, refresh=()):
+        """
+        Declare queues in parallel.  Skip queues declared recently unless
+        they are in the `refresh` set.  Call passed callback without
+        arguments afterwards.
+        """
+
+        unknown_queues = set(
+            queue for queue in queues
+            if queue in refresh or queue not in self.topology.queues
+        )
+        if not unknown_queues:
+            callback()
+            return
+        for queue in list(unknown_queues):
+            arguments = self.queue_arguments(queue)
+            self.amqp_channel.queue_declare(
+                partial(
+                    self.queue_declared,
+                    partial(self.queues_declared, callback, unknown_queues,
+                            queue),
+                    arguments,
+                ),
+                queue,
+                arguments=arguments,
+            )
+
+    def queues_declared(self, callback, unknown_queues, queue):
+        """One queue was declared.  Continue if it was the last one."""
+
+        unknown_queues.discard(queue)
+        # If all queues are known at this moment, that basically means
+        # we are in the last callback and can safely go further.  If
+        # any queue isn't known, we simply skip processing at this
+        # point.
+        if not unknown_queues:
+            callback()
+
+    def queue_declared(self, callback, arguments, method_frame):
+        """Remember declared queue and its length."""
+
+        self.topology.queues.set(
+            method_frame.method.queue,
+            method_frame.method.message_count,
+            ttl=self.topology.queue_ttl(arguments),
+        )
+        callback()
 
     # Send.
 
-    def send(self, channel, message):
-        """Start message sending.  Declare necessary queue first."""
+    def send(self, channel, body):
+        """
+        Start message sending.  Declare necessary queue first, unless we
+        know it has enough space for this message.
+        """
+
+        # Thread may not wait for the result of this method.  Next
+        # scheduled method will replace current future.
+        self.check_queue(
+            channel,
+            partial(self.handle_publish, self.resolve, channel, body),
+        )
+
+    def check_queue(self, channel, publish, count=1):
+        """
+        Declare channel queue to get its length.  With queue length cache
+        skip declare if queue we know about has space for `count` more
+        messages.  Call `publish` without arguments afterwards.
+        """
 
         queue = self.get_queue_name(channel)
+        if self.broker_capacity and count == 1:
+            # Broker will reject message itself if queue is full.
+            self.declare_queues(publish, [queue])
+            return
+        known_length = self.topology.queues.get(queue)
+        if (self.queue_length_cache and not self.broker_capacity and
+                known_length is not None and
+                known_length + count <= self.get_capacity(channel)):
+            publish()
+            return
+        # Queue length we know about only grows with our own publishes.
+        # Ask broker for the real length before reject message.
+        arguments = self.queue_arguments(queue)
         self.amqp_channel.queue_declare(
-            partial(self.handle_publish, channel, message),
+            partial(self.queue_declared, publish, arguments),
             queue=queue,
-            arguments=self.queue_arguments,
+            arguments=arguments,
         )
 
-    def handle_publish(self, channel, message, method_frame):
+    def handle_publish(self, resolve, channel, body):
         """Queue declared.  Check channel capacity."""
 
-        if method_frame.method.message_count >= self.get_capacity(channel):
-            self.resolve.set_exception(RabbitmqChannelLayer.ChannelFull())
+        if not self.has_capacity(channel):
+            resolve.set_exception(RabbitmqChannelLayer.ChannelFull())
             return
-        body = self.serialize(message)
-        self.publish_message(channel, body)
+        self.publish_message(resolve, channel, body)
 
-    def publish_message(self, channel, body):
-        """Channel capacity check is done.  Publish message."""
+    def has_capacity(self, channel, count=1, force=False):
+        """
+        Check channel queue length we know about.  Count `count` more
+        messages in it if it has enough space.  Broker does this check
+        itself in the broker capacity mode unless `force` is set.
+        """
 
+        if self.broker_capacity and not force:
+            return True
         queue = self.get_queue_name(channel)
-        self.amqp_channel.basic_publish(
+        length = self.topology.queues.get(queue, 0)
+        if length + count > self.get_capacity(channel):
+            return False
+        if queue in self.topology.queues:
+            self.topology.queues.replace(queue, length + count)
+        return True
+
+    def publish_message(self, resolve, channel, body):
+        """
+        Channel capacity check is done.  Publish message.  In the confirm
+        mode wait for the broker acknowledgment.
+        """
+
+        self.publish_to_channel(channel, body)
+        self.wait_confirmation(resolve, RabbitmqChannelLayer.ChannelFull)
+
+    def publish_to_channel(self, channel, body):
+        """Publish message to the channel queue."""
+
+        queue = self.get_queue_name(channel)
+        self.publish(
             exchange='',
             routing_key=queue,
             body=body,
             properties=self.publish_properties(channel),
         )
-        self.resolve.set_result(None)
+
+    def publish(self, exchange, routing_key, body, properties=None,
+                mandatory=False):
+        """
+        Publish message to the exchange.  Count delivery tags in the
+        confirm mode.
+        """
+
+        self.amqp_channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=properties,
+            mandatory=mandatory,
+        )
+        if self.confirm_delivery:
+            self.delivery_tag += 1
+
+    def wait_confirmation(self, resolve, nack_error=None):
+        """
+        Resolve waiting thread when broker confirms last published
+        message.  Resolve it immediately if confirm mode is disabled.
+        Rejected message will raise `nack_error` if given.
+        """
+
+        if self.confirm_delivery:
+            self.unconfirmed[self.delivery_tag] = (resolve, nack_error)
+        else:
+            resolve.set_result(None)
+
+    def on_confirmation(self, method_frame):
+        """
+        Broker confirmed published messages.  Nack means the queue is
+        full and rejects new messages.  Many messages can be in flight
+        at the same time.
+        """
+
+        method = method_frame.method
+        if method.multiple:
+            tags = sorted(
+                tag for tag in self.unconfirmed if tag <= method.delivery_tag
+            )
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            future, nack_error = self.unconfirmed.pop(tag, (None, None))
+            if future is None or future.done():
+                continue
+            if isinstance(method, Basic.Ack) or nack_error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(nack_error())
+
+    # Send chunks.
+
+    def send_chunks(self, channel, message_id, chunks):
+        """
+        Start sending of the message split into chunks.  Each chunk is a
+        separate AMQP message in the channel queue.  Ask broker for the
+        real queue length, unless we know it has space for all of them.
+        """
+
+        self.check_queue(
+            channel,
+            partial(self.publish_chunks, self.resolve, channel, message_id,
+                    chunks),
+            len(chunks),
+        )
+
+    def publish_chunks(self, resolve, channel, message_id, chunks):
+        """
+        Queue declared.  Publish all chunks if queue has enough space for
+        each of them.  Broker would reject tail chunks one by one in the
+        broker capacity mode, so we check the whole message ourselves
+        before publishing any chunk.  In the confirm mode wait for
+        acknowledgment of every chunk.
+        """
+
+        if not self.has_capacity(channel, len(chunks), force=True):
+            resolve.set_exception(RabbitmqChannelLayer.ChannelFull())
+            return
+        queue = self.get_queue_name(channel)
+        total = len(chunks)
+        waiting = set()
+        for index, chunk in enumerate(chunks):
+            self.publish(
+                exchange='',
+                routing_key=queue,
+                body=chunk,
+                properties=self.chunk_properties(channel, message_id, index,
+                                                 total),
+            )
+            if self.confirm_delivery:
+                confirmation = Future()
+                self.unconfirmed[self.delivery_tag] = (
+                    confirmation,
+                    RabbitmqChannelLayer.ChannelFull,
+                )
+                waiting.add(confirmation)
+        if not waiting:
+            resolve.set_result(None)
+            return
+        for confirmation in list(waiting):
+            confirmation.add_done_callback(
+                partial(self.chunk_confirmed, resolve, waiting),
+            )
+
+    def chunk_confirmed(self, resolve, waiting, confirmation):
+        """
+        Broker confirmed one chunk.  Fail waiting thread if chunk was
+        rejected.  Resolve it if it was the last one.
+        """
+
+        waiting.discard(confirmation)
+        if resolve.done():
+            return
+        error = confirmation.exception()
+        if error is not None:
+            resolve.set_exception(error)
+        elif not waiting:
+            resolve.set_result(None)
+
+    def chunk_properties(self, channel, message_id, index, total):
+        """AMQP message properties of the message chunk."""
+
+        headers = {'asgi_chunk': [index, total]}
+        if '!' in channel:
+            headers['asgi_channel'] = channel.rsplit('!')[-1]
+        return BasicProperties(
+            headers=headers,
+            message_id=message_id,
+            expiration=self.properties.expiration,
+        )
+
+    def assemble(self, properties, body):
+        """
+        Pass received message body through the chunks buffer.  Return
+        `None` if it was a chunk of the message not received completely.
+        """
+
+        if not properties.headers or 'asgi_chunk' not in properties.headers:
+            return body
+        index, total = properties.headers['asgi_chunk']
+        return self.chunks.add(properties.message_id, index, total, body,
+                               self.expiry)
+
+    # Send many.
+
+    def send_many(self, batch):
+        """
+        Start sending of many serialized messages.  Declare each queue
+        once.  With queue length cache ask broker for the real queue
+        length only if we may exceed channel capacity.
+        """
+
+        lengths = {}
+        capacities = {}
+        for channel, _ in batch:
+            queue = self.get_queue_name(channel)
+            lengths[queue] = lengths.get(queue, 0) + 1
+            capacities[queue] = min(capacities.get(queue, float('inf')),
+                                    self.get_capacity(channel))
+        refresh = set()
+        if not self.broker_capacity:
+            for queue, length in lengths.items():
+                known_length = self.topology.queues.get(queue)
+                if (not self.queue_length_cache or
+                        known_length is not None and
+                        known_length + length > capacities[queue]):
+                    refresh.add(queue)
+        self.declare_queues(
+            partial(self.publish_many, self.resolve, batch),
+            list(lengths),
+            refresh,
+        )
+
+    def publish_many(self, resolve, batch):
+        """
+        Queues declared.  Publish all messages with enough capacity.
+        Resolve waiting thread with the list of results.
+        """
+
+        results = [None] * len(batch)
+        confirmations = []
+        for index, (channel, body) in enumerate(batch):
+            if not self.has_capacity(channel):
+                results[index] = RabbitmqChannelLayer.ChannelFull()
+                continue
+            self.publish_to_channel(channel, body)
+            if self.confirm_delivery:
+                confirmation = Future()
+                self.unconfirmed[self.delivery_tag] = (
+                    confirmation,
+                    RabbitmqChannelLayer.ChannelFull,
+                )
+                confirmations.append((index, confirmation))
+        if not confirmations:
+            resolve.set_result(results)
+            return
+        # Wait for broker to confirm all published messages.
+        waiting = set(index for index, _ in confirmations)
+        for index, confirmation in confirmations:
+            confirmation.add_done_callback(
+                partial(self.many_confirmed, resolve, results, waiting,
+                        index),
+            )
+
+    def many_confirmed(self, resolve, results, waiting, index, confirmation):
+        """
+        Broker confirmed one message of the batch.  Resolve waiting
+        thread if it was the last one.
+        """
+
+        error = confirmation.exception()
+        if resolve.done():
+            return
+        if (error is not None and
+                not isinstance(error, RabbitmqChannelLayer.ChannelFull)):
+            resolve.set_exception(error)
+            return
+        results[index] = error
+        waiting.discard(index)
+        if not waiting:
+            resolve.set_result(results)
 
     def publish_properties(self, channel=None):
         """AMQP message properties."""
 
         # Store local part of the process local channel in the AMQP
-        # message header.
+        # message header.  Only this case needs its own properties
+        # instance.
         if channel and '!' in channel:
-            headers = {'asgi_channel': channel.rsplit('!')[-1]}
-        else:
-            headers = None
-        # Specify message expiration in milliseconds.
-        expiration = str(self.expiry * 1000)
-        properties = BasicProperties(headers=headers, expiration=expiration)
-        return properties
+            return BasicProperties(
+                headers={'asgi_channel': channel.rsplit('!')[-1]},
+                expiration=self.properties.expiration,
+            )
+        return self.properties
 
     # Receive.
 
     def receive(self, channels, block):
         """Initiate message receive."""
 
-        # Declare necessary queues in parallel.
+        # Declare necessary queues in parallel.  Skip queues declared
+        # recently.
         queues = set(map(self.get_queue_name, channels))
-        known_queues = set()
-        queues_declared = partial(self.queues_declared, queues, known_queues,
-                                  channels, block)
-        for queue in queues:
-            self.amqp_channel.queue_declare(
-                queues_declared,
-                queue,
-                arguments=self.queue_arguments,
-            )
+        self.declare_queues(partial(self.start_receive, channels, block),
+                            queues)
 
-    def queues_declared(self, queues, known_queues, channels, block,
-                        method_frame):
-        """One queue was declared.  Continue if it was the last one."""
+    def start_receive(self, channels, block):
+        """All queues were declared.  Start receive in the right mode."""
 
-        known_queues.add(method_frame.method.queue)
-        # If all queues are known at this moment, that basically means
-        # we are in the last callback and can safely go further.  If
-        # any queue isn't known, we simply skip processing at this
-        # point.
-        unknown_queues = queues - known_queues
-        if unknown_queues:
+        if self.inbox and self.pop_inbox(channels):
             return
-        if block:
+        if block and self.prefetch_count:
+            self.start_consuming(channels)
+        elif block:
             self.start_blocking_receive(channels)
         else:
             channels = list(channels)  # Daphne sometimes pass dict.keys()
@@ -181,88 +976,500 @@ class Protocol(object):
 
     # Blocking receive.
 
-    def start_blocking_receive(self, channels):
+    def start_blocking_receive(self, channels, resolve=None):
         """Create parallel consumers in one AMQP channel."""
 
         # In blocking mode create consumers in parallel.
+        resolve = resolve or self.resolve
         consumer_tags = {}
         for channel in channels:
             tag = self.amqp_channel.basic_consume(
-                partial(self.consume_message, consumer_tags),
+                partial(self.consume_message, resolve, consumer_tags),
                 queue=self.get_queue_name(channel),
+                no_ack=self.no_ack,
             )
             consumer_tags[tag] = channel
+        self.blocking[resolve] = consumer_tags
+        self.cancellable[resolve] = partial(self.stop_blocking_receive,
+                                            resolve)
 
-    def consume_message(self, consumer_tags, amqp_channel, method_frame,
-                        properties, body):
+    def cancel_consumers(self, resolve):
+        """Cancel parallel consumers of the blocking receive."""
 
-        amqp_channel.basic_ack(method_frame.delivery_tag)
-        # Cancel parallel consumers.
-        for tag in consumer_tags:
-            amqp_channel.basic_cancel(consumer_tag=tag, nowait=True)
-        # Send the message to the waiting thread.
+        self.cancellable.pop(resolve, None)
+        for tag in self.blocking.pop(resolve, ()):
+            self.amqp_channel.basic_cancel(consumer_tag=tag, nowait=True)
+
+    def stop_blocking_receive(self, resolve):
+        """Blocking receive was timed out.  Return empty response."""
+
+        self.cancel_consumers(resolve)
+        resolve.set_result((None, None))
+
+    def consume_message(self, resolve, consumer_tags, amqp_channel,
+                        method_frame, properties, body):
+
+        self.ack(method_frame.delivery_tag)
+        body = self.assemble(properties, body)
+        if body is None:
+            # Message isn't complete yet.  Wait for the next chunk.
+            return
+        self.cancel_consumers(resolve)
+        # Send the message body to the waiting thread.  It will
+        # deserialize message itself.
         channel = consumer_tags[method_frame.consumer_tag]
-        if properties.headers and 'asgi_channel' in properties.headers:
-            channel = channel + properties.headers['asgi_channel']
-        message = self.deserialize(body)
-        self.resolve.set_result((channel, message))
+        channel = self.message_channel(channel, properties)
+        resolve.set_result((channel, body))
+
+    # Persistent consumers.
+
+    def start_consuming(self, channels):
+        """
+        Wait for the next delivery of the persistent consumers.  Start
+        consumers of the new channels and cancel consumers of the
+        channels thread doesn't receive from anymore.
+        """
+
+        self.receiving = list(OrderedDict.fromkeys(channels))
+        channels = set(self.receiving)
+        if not self.consumers:
+            self.amqp_channel.basic_qos(prefetch_count=self.prefetch_count)
+        for channel in list(self.consumers):
+            if channel not in channels:
+                self.stop_consuming(channel)
+        for channel in channels:
+            if channel not in self.consumers:
+                self.consumers[channel] = self.amqp_channel.basic_consume(
+                    partial(self.on_delivery, channel),
+                    queue=self.get_queue_name(channel),
+                    no_ack=self.no_ack,
+                )
+        self.receiver = self.resolve
+
+    def stop_consuming(self, channel):
+        """
+        Cancel consumer of the channel.  Return its messages we hold
+        back to the queue.
+        """
+
+        tag = self.consumers.pop(channel)
+        self.amqp_channel.basic_cancel(consumer_tag=tag, nowait=True)
+        inbox = deque()
+        for message in self.inbox:
+            delivery_tag, consumer_channel, _, _ = message
+            if consumer_channel != channel:
+                inbox.append(message)
+            elif delivery_tag is not None:
+                self.amqp_channel.basic_reject(delivery_tag, requeue=True)
+            else:
+                # Chunked message was acknowledged already.  Keep it
+                # for the next receive from this channel.
+                inbox.append(message)
+        self.inbox = inbox
+
+    def on_delivery(self, consumer_channel, amqp_channel, method_frame,
+                    properties, body):
+        """
+        Persistent consumer callback.  Store message in the inbox.  Pass
+        it to the waiting thread if any.
+        """
+
+        delivery_tag = None if self.no_ack else method_frame.delivery_tag
+        if properties.headers and 'asgi_chunk' in properties.headers:
+            # Chunks are stored in the reassembly buffer.  We can't
+            # hold them unacknowledged.
+            self.ack(delivery_tag)
+            delivery_tag = None
+            body = self.assemble(properties, body)
+            if body is None:
+                return
+        channel = consumer_channel
+        channel = self.message_channel(channel, properties)
+        self.inbox.append((delivery_tag, consumer_channel, channel, body))
+        if self.receiver is not None:
+            self.pop_inbox(self.receiving)
+
+    def pop_inbox(self, channels):
+        """
+        Pass message of the given channels from the inbox to the waiting
+        thread.  Return `False` if there is no such message.
+        """
+
+        message = self.take_inbox(channels)
+        if message is None:
+            return False
+        resolve = self.receiver or self.resolve
+        self.receiver = None
+        resolve.set_result(message)
+        return True
+
+    def take_inbox(self, channels):
+        """
+        Take message of the given channels from the inbox.  Receive
+        scheduler chooses the channel.  Acknowledge message at this
+        moment, so broker can deliver next one.  Return `None` if there
+        is no such message.
+        """
+
+        channels = list(channels)
+        waiting = set(message[1] for message in self.inbox)
+        candidates = [channel for channel in OrderedDict.fromkeys(channels)
+                      if channel in waiting]
+        if not candidates:
+            return None
+        # Scheduler needs all channels of the receive to keep its
+        # rotation position.
+        chosen = self.scheduler.choose(channels, candidates)
+        for index, message in enumerate(self.inbox):
+            delivery_tag, consumer_channel, channel, body = message
+            if consumer_channel == chosen:
+                break
+        del self.inbox[index]
+        if delivery_tag is not None:
+            self.ack(delivery_tag)
+        return channel, body
+
+    # Acknowledgments.
+
+    def ack(self, delivery_tag):
+        """Acknowledge received message according to the policy."""
+
+        if self.no_ack or delivery_tag is None:
+            return
+        if self.ack_policy != 'coalesced':
+            self.amqp_channel.basic_ack(delivery_tag)
+            return
+        self.ack_tags.append(delivery_tag)
+        if len(self.ack_tags) >= self.ack_batch:
+            self.flush_acks()
+        elif self.ack_timer is None:
+            self.ack_timer = self.amqp_channel.connection.add_timeout(
+                self.ack_interval,
+                self.on_ack_timer,
+            )
+
+    def flush_acks(self):
+        """
+        Acknowledge remembered messages.  Use one frame for all of them
+        unless we hold unacknowledged messages with smaller tags.
+        """
+
+        if self.ack_timer is not None:
+            self.amqp_channel.connection.remove_timeout(self.ack_timer)
+            self.ack_timer = None
+        tags, self.ack_tags = self.ack_tags, []
+        if not tags or not self.amqp_channel.is_open:
+            return
+        last_tag = max(tags)
+        held = [message[0] for message in self.inbox if message[0] is not None]
+        held.extend(self.held)
+        if not held or min(held) > last_tag:
+            self.amqp_channel.basic_ack(last_tag, multiple=True)
+            return
+        for tag in tags:
+            self.amqp_channel.basic_ack(tag)
+
+    def on_ack_timer(self):
+        """
+        Acknowledgment interval is gone.  Timers are called outside of
+        the frame processing, so we need to take connection lock.
+        """
+
+        with self.amqp_channel.connection.lock:
+            self.ack_timer = None
+            self.flush_acks()
 
     # Non blocking receive.
 
     def start_non_blocking_receive(self, channels):
-        """Sequentially check each channel queue."""
-
-        # In the non-blocking mode get the message from each queue
-        # in series.
-        channel = channels[0]
-        no_message = partial(self.no_message, channels[1:])
-        self.amqp_channel.add_callback(no_message, [Basic.GetEmpty])
-        self.amqp_channel.basic_get(
-            partial(self.get_message, channel, no_message),
-            queue=self.get_queue_name(channel),
+        """Check all channel queues in parallel."""
+
+        # In the non-blocking mode get the message from each queue at
+        # once.  Broker answers in the order of requests.
+        results = [None] * len(channels)
+        waiting = set(range(len(channels)))
+        for index in range(len(channels)):
+            self.get_from_channel(self.resolve, channels, results, waiting,
+                                  index)
+
+    def get_from_channel(self, resolve, channels, results, waiting, index):
+        """Get one message from the channel queue."""
+
+        arguments = (resolve, channels, results, waiting, index)
+        self.amqp_channel.pipeline_get(
+            partial(self.get_message, *arguments),
+            partial(self.no_message, *arguments),
+            queue=self.get_queue_name(channels[index]),
+            no_ack=self.no_ack,
         )
 
-    def get_message(self, channel, no_message, amqp_channel, method_frame,
-                    properties, body):
+    def get_message(self, resolve, channels, results, waiting, index,
+                    amqp_channel, method_frame, properties, body):
         """Message was received in the non-blocking mode."""
 
-        # Cancel no message callback for this queue.
-        amqp_channel.callbacks.remove(
-            amqp_channel.channel_number,
-            Basic.GetEmpty,
-            no_message,
+        delivery_tag = None if self.no_ack else method_frame.delivery_tag
+        if properties.headers and 'asgi_chunk' in properties.headers:
+            self.ack(delivery_tag)
+            delivery_tag = None
+            body = self.assemble(properties, body)
+            if body is None:
+                # Message isn't complete yet.  Get next chunk from the
+                # same queue.
+                self.get_from_channel(resolve, channels, results, waiting,
+                                      index)
+                return
+        if delivery_tag is not None:
+            self.held.add(delivery_tag)
+        channel = channels[index]
+        channel = self.message_channel(channel, properties)
+        results[index] = (delivery_tag, channels[index], channel, body)
+        self.got_reply(resolve, channels, results, waiting, index)
+
+    def no_message(self, resolve, channels, results, waiting, index,
+                   method_frame):
+        """The queue is empty."""
+
+        self.got_reply(resolve, channels, results, waiting, index)
+
+    def got_reply(self, resolve, channels, results, waiting, index):
+        """
+        Broker answered one get request.  If it was the last one, pass
+        message chosen by receive scheduler to the waiting thread.
+        Return other messages to their queues.
+        """
+
+        waiting.discard(index)
+        if waiting:
+            return
+        received = [result for result in results if result is not None]
+        for message in received:
+            self.held.discard(message[0])
+        if not received:
+            resolve.set_result((None, None))
+            return
+        chosen = self.scheduler.choose(
+            channels,
+            [message[1] for message in received],
         )
-        # Send the message to the waiting thread.
-        amqp_channel.basic_ack(method_frame.delivery_tag)
-        if properties.headers and 'asgi_channel' in properties.headers:
-            channel = channel + properties.headers['asgi_channel']
-        message = self.deserialize(body)
-        self.resolve.set_result((channel, message))
+        for message in received:
+            if message[1] == chosen:
+                break
+        received.remove(message)
+        delivery_tag, _, channel, body = message
+        # Reject other messages first.  Coalesced acknowledgment of the
+        # chosen one may cover smaller delivery tags.
+        for message in received:
+            if message[0] is not None:
+                self.amqp_channel.basic_reject(message[0], requeue=True)
+            else:
+                # Chunked message was acknowledged already.  Keep it
+                # for the next receive.
+                self.inbox.append(message)
+        self.ack(delivery_tag)
+        # Send the message body to the waiting thread.
+        resolve.set_result((channel, body))
+
+    # Batch receive.
+
+    def receive_batch(self, channels, max_messages, timeout):
+        """Initiate receive of many messages."""
 
-    def no_message(self, channels, method_frame):
+        channels = list(channels)
+        queues = set(map(self.get_queue_name, channels))
+        self.declare_queues(
+            partial(self.start_receive_batch, self.resolve, channels,
+                    max_messages, timeout),
+            queues,
+        )
+
+    def start_receive_batch(self, resolve, channels, max_messages, timeout):
         """
-        The queue is empty.  Tries to read from next channel in
-        non-blocking mode.
+        Take messages we hold in the inbox first.  Get the rest from all
+        channel queues in parallel.  Receive scheduler decides which of
+        them to keep.
         """
 
-        if channels:
-            self.start_non_blocking_receive(channels)
-        else:
-            self.resolve.set_result((None, None))
+        messages = []
+        while self.inbox and len(messages) < max_messages:
+            message = self.take_inbox(channels)
+            if message is None:
+                break
+            messages.append(message)
+        if len(messages) == max_messages:
+            resolve.set_result(messages)
+            return
+        received = []
+        waiting = set()
+        for channel in channels:
+            self.get_for_batch(resolve, messages, received, waiting,
+                               max_messages, timeout, channels, channel)
+
+    def get_for_batch(self, resolve, messages, received, waiting,
+                      max_messages, timeout, channels, channel):
+        """Get one more message of the batch from the channel queue."""
+
+        request = object()
+        waiting.add(request)
+        arguments = (resolve, messages, received, waiting, max_messages,
+                     timeout, channels, channel, request)
+        self.amqp_channel.pipeline_get(
+            partial(self.batch_message, *arguments),
+            partial(self.batch_empty, *arguments),
+            queue=self.get_queue_name(channel),
+            no_ack=self.no_ack,
+        )
 
-    @property
-    def queue_arguments(self):
-        """Channel queue declaration arguments."""
+    def batch_message(self, resolve, messages, received, waiting,
+                      max_messages, timeout, channels, consumer_channel,
+                      request, amqp_channel, method_frame, properties, body):
+        """
+        Message of the batch was received.  Ask the same queue for the
+        next one unless batch is full.
+        """
+
+        waiting.discard(request)
+        arguments = (resolve, messages, received, waiting, max_messages,
+                     timeout, channels, consumer_channel)
+        delivery_tag = None if self.no_ack else method_frame.delivery_tag
+        if properties.headers and 'asgi_chunk' in properties.headers:
+            self.ack(delivery_tag)
+            delivery_tag = None
+            body = self.assemble(properties, body)
+            if body is None:
+                self.get_for_batch(*arguments)
+                return
+        if delivery_tag is not None:
+            self.held.add(delivery_tag)
+        channel = consumer_channel
+        channel = self.message_channel(channel, properties)
+        received.append((delivery_tag, consumer_channel, channel, body))
+        if len(messages) + len(received) + len(waiting) < max_messages:
+            self.get_for_batch(*arguments)
+        self.batch_received(*arguments[:-1])
+
+    def batch_empty(self, resolve, messages, received, waiting, max_messages,
+                    timeout, channels, consumer_channel, request,
+                    method_frame):
+        """Channel queue has no more messages."""
+
+        waiting.discard(request)
+        self.batch_received(resolve, messages, received, waiting,
+                            max_messages, timeout, channels)
+
+    def batch_received(self, resolve, messages, received, waiting,
+                       max_messages, timeout, channels):
+        """
+        Broker answered get request.  If it was the last one, pass
+        messages chosen by receive scheduler to the waiting thread.
+        Return other messages to their queues.  Wait for the first
+        message up to `timeout` seconds if there are none.
+        """
+
+        if waiting:
+            return
+        if not messages and not received and timeout:
+            self.wait_for_batch(resolve, channels, timeout)
+            return
+        for message in received:
+            self.held.discard(message[0])
+        kept = []
+        while received and len(messages) + len(kept) < max_messages:
+            pending = set(message[1] for message in received)
+            candidates = [channel for channel in OrderedDict.fromkeys(channels)
+                          if channel in pending]
+            chosen = self.scheduler.choose(channels, candidates)
+            for message in received:
+                if message[1] == chosen:
+                    break
+            received.remove(message)
+            kept.append(message)
+        # Reject other messages first.  Coalesced acknowledgment of the
+        # kept ones may cover smaller delivery tags.
+        for message in received:
+            if message[0] is not None:
+                self.amqp_channel.basic_reject(message[0], requeue=True)
+            else:
+                # Chunked message was acknowledged already.  Keep it
+                # for the next receive.
+                self.inbox.append(message)
+        for delivery_tag, _, channel, body in kept:
+            self.ack(delivery_tag)
+            messages.append((channel, body))
+        resolve.set_result(messages)
+
+    def wait_for_batch(self, resolve, channels, timeout):
+        """
+        All queues are empty.  Wait for the first message with parallel
+        consumers.
+        """
+
+        first = Future()
+        self.start_blocking_receive(channels, first)
+        on_timeout = partial(self.stop_blocking_receive, first)
+        self.cancellable[resolve] = on_timeout
 
-        return {
+        def on_message(future):
+
+            self.cancellable.pop(resolve, None)
+            channel, body = future.result()
+            resolve.set_result([] if channel is None else [(channel, body)])
+
+        first.add_done_callback(on_message)
+        self.start_timer(first, timeout, on_timeout)
+
+    def start_timer(self, resolve, timeout, on_timeout):
+        """
+        Call `on_timeout` if future isn't resolved in `timeout` seconds.
+        Timers are called outside of the frame processing, so we take
+        connection lock.
+        """
+
+        connection = self.amqp_channel.connection
+
+        def expired():
+
+            with connection.lock:
+                if not resolve.done():
+                    on_timeout()
+
+        timer = connection.add_timeout(timeout, expired)
+        resolve.add_done_callback(
+            lambda future: connection.remove_timeout(timer),
+        )
+
+    def queue_arguments(self, queue):
+        """
+        Channel queue declaration arguments.  With direct local groups
+        process queue expires messages itself.  Dead lettering strips
+        `expiration` property of group messages routed there.
+        """
+
+        capacity = self.get_capacity(queue) if self.broker_capacity else None
+        local = self.direct_local_groups and queue.endswith('!')
+        key = (capacity, local)
+        try:
+            return self.channel_arguments[key]
+        except KeyError:
+            pass
+        arguments = {
             'x-dead-letter-exchange': self.dead_letters,
             'x-expires': self.expiry * 2000,
         }
+        if capacity is not None:
+            arguments['x-max-length'] = capacity
+            arguments['x-overflow'] = 'reject-publish'
+        if local:
+            arguments['x-message-ttl'] = self.expiry * 1000
+        self.channel_arguments[key] = arguments
+        return arguments
 
     # Twisted receive.
 
     def receive_twisted(self, channels):
 
+        # Twisted receive uses pooled AMQP channels.  Persistent
+        # consumers stay there until channel is closed or taken by
+        # receive from other channels.
         self.receive(channels, block=True)
 
     # New channel.
@@ -270,13 +1477,15 @@ class Protocol(object):
     def new_channel(self, new_name):
         """Initiate new single reader channel creation."""
 
+        arguments = self.queue_arguments(new_name)
         self.amqp_channel.queue_declare(
-            self.new_channel_declared,
+            partial(self.queue_declared, self.new_channel_declared,
+                    arguments),
             queue=new_name,
-            arguments=self.queue_arguments,
+            arguments=arguments,
         )
 
-    def new_channel_declared(self, method_frame):
+    def new_channel_declared(self):
         """Notify waiting thread new single reader channel was created."""
 
         self.resolve.set_result(None)
@@ -286,11 +1495,23 @@ class Protocol(object):
     def group_add(self, group, channel):
         """Initiate member addition to the group."""
 
-        self.expire_group_member(group, channel)
+        self.topology.empty_groups.discard(group)
+        if (group, channel) in self.topology.refreshed:
+            # Membership was refreshed recently.
+            self.resolve.set_result(None)
+            return
+        if self.pipeline_group_add or self.group_routing == 'direct':
+            self.group_add_many([(group, channel)])
+            return
+
+        bucket = self.expiry_bucket()
+        arguments = self.binding_arguments(bucket)
+        self.expire_group_member(group, channel, bucket)
 
         # The last callback.
         def after_bind(method_frame):
 
+            self.refresh_membership(group, channel)
             self.resolve.set_result(None)
 
         if '!' in channel:
@@ -304,6 +1525,7 @@ class Protocol(object):
                     callback=after_bind,
                     queue=channel,
                     exchange=group,
+                    arguments=arguments,
                 )
 
             def declare_member(method_frame):
@@ -311,11 +1533,7 @@ class Protocol(object):
                 self.amqp_channel.queue_declare(
                     callback=bind_channel,
                     queue=channel,
-                    arguments={
-                        'x-dead-letter-exchange': self.dead_letters,
-                        'x-expires': self.group_expiry * 1000,
-                        'x-max-length': 0,
-                    },
+                    arguments=self.member_queue_arguments(channel),
                 )
         else:
             # Regular channel and single reader channels needs
@@ -336,6 +1554,7 @@ class Protocol(object):
                     bind_channel,
                     destination=channel,
                     source=group,
+                    arguments=arguments,
                 )
 
             def declare_channel(method_frame):
@@ -343,10 +1562,9 @@ class Protocol(object):
                 if '?' in channel:
                     bind_group(None)
                 else:
-                    self.amqp_channel.queue_declare(
-                        bind_group,
-                        queue=self.get_queue_name(channel),
-                        arguments=self.queue_arguments,
+                    self.declare_queues(
+                        partial(bind_group, None),
+                        [self.get_queue_name(channel)],
                     )
 
             def declare_member(method_frame):
@@ -360,91 +1578,415 @@ class Protocol(object):
 
         # Declare group exchange and start one of the callback chains
         # described above.
+        self.declare_group(declare_member, group)
+
+    def group_add_many(self, memberships):
+        """
+        Initiate addition of many members to their groups.  Each group
+        exchange and each member is declared once.  Everything is sent
+        with `nowait` flag except the last marker queue declaration.
+        Broker applies channel methods in order, so its reply means the
+        whole batch is in place.  Any error closes AMQP channel and
+        fails the waiting thread.
+        """
+
+        resolve = self.resolve
+        memberships = list(OrderedDict.fromkeys(memberships))
+        if not memberships:
+            resolve.set_result(None)
+            return
+        for group, channel in memberships:
+            self.topology.empty_groups.discard(group)
+        memberships = [membership for membership in memberships
+                       if membership not in self.topology.refreshed]
+        if not memberships:
+            resolve.set_result(None)
+            return
+        bucket = self.expiry_bucket()
+        if self.pipeline_group_add:
+            # Membership known to be in place only renews expiration.
+            # Binding of the new bucket is added anyway.
+            added = [membership for membership in memberships
+                     if membership + (bucket,) not in self.topology.bindings]
+        else:
+            added = memberships
+        groups = OrderedDict.fromkeys(
+            self.group_exchange(group)[0] for group, channel in added
+        )
+        for exchange in groups:
+            if exchange not in self.topology.exchanges:
+                self.amqp_channel.exchange_declare(
+                    exchange=exchange,
+                    exchange_type=self.group_exchange_type(),
+                    nowait=True,
+                )
+        for channel in OrderedDict.fromkeys(channel for _, channel in added):
+            self.declare_member(channel)
+        for group, channel in added:
+            self.bind_member(group, channel, bucket)
+
+        def markers_declared(method_frame):
+
+            for group, channel in memberships:
+                self.topology.exchanges.set(self.group_exchange(group)[0],
+                                            True, ttl=self.expiry)
+                if self.pipeline_group_add:
+                    self.topology.bindings.set((group, channel, bucket),
+                                               True, ttl=self.expiry)
+                self.refresh_membership(group, channel)
+                self.push_marker(group, channel, bucket, None)
+            resolve.set_result(None)
+
+        # Markers are pushed after the last declaration.  Their queues
+        # are surely declared at this moment.  All memberships share
+        # one queue in the bucketed mode.
+        marker_queues = OrderedDict(
+            self.marker_queue(group, channel, bucket)
+            for group, channel in memberships
+        )
+        last = len(marker_queues) - 1
+        for index, (queue, arguments) in enumerate(marker_queues.items()):
+            self.amqp_channel.queue_declare(
+                markers_declared if index == last else None,
+                queue=queue,
+                arguments=arguments,
+                nowait=index != last,
+            )
+
+    def refresh_membership(self, group, channel):
+        """Remember the member was added to the group just now."""
+
+        if self.group_refresh_window:
+            self.topology.refreshed.set((group, channel), True,
+                                        ttl=self.group_refresh_window)
+
+    def declare_member(self, channel):
+        """
+        Declare intermediate exchange or queue of the group member
+        without waiting for the reply.
+        """
+
+        if '!' in channel:
+            # Process local channels needs its own queue for
+            # membership.  This queue will be bound to the group
+            # exchange.
+            self.amqp_channel.queue_declare(
+                None,
+                queue=channel,
+                arguments=self.member_queue_arguments(channel),
+                nowait=True,
+            )
+            return
+        queue = self.get_queue_name(channel)
+        if '?' not in channel and queue not in self.topology.queues:
+            self.amqp_channel.queue_declare(
+                None,
+                queue=queue,
+                arguments=self.queue_arguments(queue),
+                nowait=True,
+            )
+        if self.group_routing == 'direct':
+            # Channel queue is bound to the shared exchange itself.
+            return
+        # Regular channel and single reader channels needs exchange to
+        # exchange binding.  So message will be routed to the queue
+        # without dead letters mechanism.
         self.amqp_channel.exchange_declare(
-            declare_member,
-            exchange=group,
+            exchange=channel,
             exchange_type='fanout',
+            auto_delete=True,
+            nowait=True,
+        )
+        self.amqp_channel.queue_bind(
+            None,
+            queue=channel,
+            exchange=channel,
+            nowait=True,
         )
 
-    def group_discard(self, group, channel):
-        """Initiate member removing from the group."""
+    def member_queue_arguments(self, channel):
+        """
+        Intermediate queue arguments of the process local member.  Group
+        messages are dead lettered immediately.  With direct local
+        groups broker routes them to the process queue itself.  Local
+        part of the channel stays in the `x-death` header.
+        """
 
-        if '!' in channel:
-            self.amqp_channel.queue_unbind(
-                lambda method_frame: self.resolve.set_result(None),
+        if not self.direct_local_groups:
+            return self.member_arguments
+        arguments = dict(self.member_arguments)
+        arguments['x-dead-letter-exchange'] = ''
+        arguments['x-dead-letter-routing-key'] = self.get_queue_name(channel)
+        return arguments
+
+    def bind_member(self, group, channel, bucket=None):
+        """Bind declared member to the group without waiting the reply."""
+
+        arguments = self.binding_arguments(bucket)
+        # Fanout exchange ignores routing key.  Pika uses queue name
+        # in that case.
+        exchange, routing_key = self.group_exchange(group)
+        if self.bound_queue(channel):
+            self.amqp_channel.queue_bind(
+                None,
+                queue=channel,
+                exchange=exchange,
+                routing_key=routing_key or None,
+                nowait=True,
+                arguments=arguments,
+            )
+        else:
+            self.amqp_channel.exchange_bind(
+                destination=channel,
+                source=group,
+                nowait=True,
+                arguments=arguments,
+            )
+
+    def unbind_member(self, group, channel, arguments=None, callback=None,
+                      nowait=False):
+        """Remove one binding of the member from the group."""
+
+        exchange, routing_key = self.group_exchange(group)
+        if self.bound_queue(channel):
+            # Queue.Unbind method has no nowait flag.  Pipeline it
+            # instead of waiting for each reply.
+            self.amqp_channel.pipeline_unbind(
+                callback,
                 queue=channel,
-                exchange=group,
+                exchange=exchange,
+                routing_key=routing_key or None,
+                arguments=arguments,
             )
         else:
             self.amqp_channel.exchange_unbind(
-                lambda method_frame: self.resolve.set_result(None),
+                callback,
                 destination=channel,
                 source=group,
+                nowait=nowait,
+                arguments=arguments,
             )
 
-    def send_group(self, group, message):
+    def group_discard(self, group, channel):
+        """Initiate member removing from the group."""
+
+        self.topology.discard_membership(group, channel)
+        if self.group_expiry_buckets:
+            # Member has a binding for each bucket it was added in.
+            self.group_discard_many([(group, channel)])
+            return
+        self.unbind_member(
+            group, channel,
+            callback=lambda method_frame: self.resolve.set_result(None),
+        )
+
+    def group_discard_many(self, memberships):
+        """
+        Initiate removing of many members from their groups.  Exchange
+        bindings are removed with `nowait` flag.  Queue.Unbind has no
+        such flag, so process local members are unbound in a pipeline
+        after them.  The reply to the last unbind resolves waiting
+        thread.  In the bucketed mode binding of each live bucket is
+        removed.
+        """
+
+        resolve = self.resolve
+        memberships = list(OrderedDict.fromkeys(memberships))
+        if not memberships:
+            resolve.set_result(None)
+            return
+        for group, channel in memberships:
+            self.topology.discard_membership(group, channel)
+        bindings = [
+            (group, channel, arguments)
+            for group, channel in memberships
+            for arguments in self.live_binding_arguments()
+        ]
+        exchanges = [binding for binding in bindings
+                     if not self.bound_queue(binding[1])]
+        queues = [binding for binding in bindings
+                  if self.bound_queue(binding[1])]
+
+        def unbound(method_frame):
+
+            resolve.set_result(None)
+
+        for index, (group, channel, arguments) in enumerate(exchanges):
+            last = not queues and index == len(exchanges) - 1
+            self.unbind_member(group, channel, arguments,
+                               unbound if last else None, nowait=not last)
+        for index, (group, channel, arguments) in enumerate(queues):
+            last = index == len(queues) - 1
+            self.unbind_member(group, channel, arguments,
+                               unbound if last else None)
+
+    def group_exchange(self, group):
+        """Exchange and routing key of the group messages."""
+
+        if self.group_routing == 'direct':
+            return self.direct_groups, group
+        return group, ''
+
+    def group_exchange_type(self):
+        """Type of the group exchange."""
+
+        return 'direct' if self.group_routing == 'direct' else 'fanout'
+
+    def bound_queue(self, channel):
+        """Check if the group member is a queue bound to the group."""
+
+        return '!' in channel or self.group_routing == 'direct'
+
+    def send_group(self, group, body):
         """
         Declare group exchange.  Pass execution to the group declared
-        callback.
+        callback.  Skip groups known to be empty.
+        """
+
+        if self.empty_group_ttl and group in self.topology.empty_groups:
+            self.resolve.set_result(None)
+            return
+        self.declare_group(
+            partial(self.group_declared, self.resolve, group, body),
+            group,
+        )
+
+    def declare_group(self, callback, group):
+        """
+        Declare group exchange unless we know it was declared recently.
+        Callback receives method frame or `None` in the second case.
         """
 
+        exchange = self.group_exchange(group)[0]
+        if exchange in self.topology.exchanges:
+            callback(None)
+            return
+
+        def group_declared(method_frame):
+
+            self.topology.exchanges.set(exchange, True, ttl=self.expiry)
+            callback(method_frame)
+
         self.amqp_channel.exchange_declare(
-            partial(self.group_declared, group, message),
-            exchange=group,
-            exchange_type='fanout',
+            group_declared,
+            exchange=exchange,
+            exchange_type=self.group_exchange_type(),
         )
 
-    def group_declared(self, group, message, method_frame):
+    def group_declared(self, resolve, group, body, method_frame):
         """Publish the message to the group exchange."""
 
-        body = self.serialize(message)
-        self.amqp_channel.basic_publish(
-            exchange=group,
-            routing_key='',
+        exchange, routing_key = self.group_exchange(group)
+        self.publish(
+            exchange=exchange,
+            routing_key=routing_key,
             body=body,
             properties=self.publish_properties(),
+            mandatory=bool(self.empty_group_ttl),
         )
-        self.resolve.set_result(None)
+        # Some group members may be full.  This isn't an error.
+        self.wait_confirmation(resolve)
+
+    def on_return(self, amqp_channel, method, properties, body):
+        """
+        Broker returned mandatory message.  Only group messages are
+        published this way, so the group has no members.
+        """
+
+        if self.group_routing == 'direct':
+            group = method.routing_key
+        else:
+            group = method.exchange
+        self.topology.empty_groups.set(group, True,
+                                       ttl=self.empty_group_ttl)
 
     # Dead letters processing.
 
-    def expire_group_member(self, group, channel):
+    def expire_group_member(self, group, channel, bucket=None):
         """
         Create the queue with group membership expiration marker message.
         """
 
-        ttl = self.group_expiry * 1000
+        if bucket is None:
+            bucket = self.expiry_bucket()
+        queue, arguments = self.marker_queue(group, channel, bucket)
         self.amqp_channel.queue_declare(
-            partial(self.push_marker, group, channel),
-            queue=self.get_expire_marker(group, channel),
-            arguments={
-                'x-dead-letter-exchange': self.dead_letters,
-                'x-max-length': 1,
-                'x-message-ttl': ttl,
-                # Give broker some time to expire message before
-                # expire whole queue.
-                'x-expires': ttl + 25,
-            },
+            partial(self.push_marker, group, channel, bucket),
+            queue=queue,
+            arguments=arguments,
         )
 
-    def push_marker(self, group, channel, method_frame):
+    def push_marker(self, group, channel, bucket, method_frame):
         """The queue was created.  Push the marker."""
 
-        body = self.serialize({
+        marker = {
             'group': group,
             'channel': channel,
-        })
-        self.amqp_channel.basic_publish(
+        }
+        properties = None
+        if bucket is not None:
+            # Each marker of the bucket expires at the bucket end.
+            marker['bucket'] = bucket
+            deadline = bucket * self.bucket_interval - time.time()
+            properties = BasicProperties(
+                expiration=str(max(int(deadline * 1000), 0)),
+            )
+        self.publish(
             exchange='',
-            routing_key=self.get_expire_marker(group, channel),
-            body=body,
+            routing_key=self.marker_queue(group, channel, bucket)[0],
+            body=self.serialize(marker),
+            properties=properties,
         )
 
+    def marker_queue(self, group, channel, bucket):
+        """Marker queue name and its declaration arguments."""
+
+        if bucket is None:
+            queue = self.get_expire_marker(group, channel)
+            return queue, self.marker_arguments
+        return 'expire.bucket.%d' % bucket, self.bucket_arguments
+
     def get_expire_marker(self, group, channel):
         """Get expire marker queue name."""
 
         return 'expire.bind.%s.%s' % (group, channel)
 
+    def expiry_bucket(self):
+        """
+        Number of the time bucket for membership added now.  Buckets are
+        counted from the epoch, so all processes agree on them.  `None`
+        without bucketed group expiry.
+        """
+
+        if not self.group_expiry_buckets:
+            return None
+        deadline = time.time() + self.group_expiry
+        return int(math.ceil(deadline / self.bucket_interval))
+
+    def binding_arguments(self, bucket):
+        """Arguments of the membership binding added in the bucket."""
+
+        if bucket is None:
+            return None
+        return {'x-asgi-bucket': bucket}
+
+    def live_binding_arguments(self):
+        """
+        Arguments of all membership bindings which may exist now.  Plain
+        binding and the binding of each bucket not expired yet.
+        """
+
+        if not self.group_expiry_buckets:
+            return [None]
+        now = time.time()
+        first = int(math.ceil(now / self.bucket_interval))
+        last = int(math.ceil((now + self.group_expiry) /
+                             self.bucket_interval))
+        return [None] + [
+            self.binding_arguments(bucket)
+            for bucket in range(first, last + 1)
+        ]
+
     def declare_dead_letters(self):
         """
         Initiate dead letters processing.  Declare dead letters exchange
@@ -491,44 +2033,74 @@ class Protocol(object):
             message = self.deserialize(body)
             group = message['group']
             channel = message['channel']
-            self.group_discard(group, channel)
+            if 'bucket' in message:
+                # Remove binding of this bucket only.  Member added
+                # again later has binding of the later bucket.
+                self.topology.discard_membership(group, channel)
+                self.unbind_member(
+                    group, channel,
+                    self.binding_arguments(message['bucket']))
+            else:
+                self.group_discard(group, channel)
         elif reason == 'expired' and not self.is_expire_marker(queue):
             # The message was expired in the channel.  Discard all
             # group membership for this channel.
             if '!' in queue:
-                queue = queue + properties.headers['asgi_channel']
+                queue = self.message_channel(queue, properties)
                 amqp_channel.queue_delete(queue=queue)
-            else:
+                self.topology.queues.discard(queue)
+            elif self.group_routing != 'direct':
                 amqp_channel.exchange_delete(exchange=queue)
+            else:
+                # Channel queue is bound to the groups itself.  Other
+                # messages may still wait there.  Group expiry removes
+                # its memberships.
+                return
+            self.topology.discard_member(queue)
         elif reason == 'maxlen' and self.is_expire_marker(queue):
             # Existing group membership was updated second time.
             return
         elif reason == 'maxlen' and '!' in queue:
             # Send group method was applied to the process local
             # channel.  Redeliver message to the right queue.
-            self.publish_message(queue, body)
+            self.publish_to_channel(queue, body)
+
+    def message_channel(self, channel, properties):
+        """
+        Channel name of the received message.  Process local channels
+        store local part in the `asgi_channel` header.  Group messages
+        routed directly into the process queue have intermediate queue
+        named after the whole channel in the `x-death` header.
+        """
+
+        headers = properties.headers
+        if not headers:
+            return channel
+        if 'asgi_channel' in headers:
+            return channel + headers['asgi_channel']
+        if channel.endswith('!'):
+            for death in headers.get('x-death', ()):
+                queue = death['queue']
+                if queue != channel and queue.startswith(channel):
+                    return queue
+        return channel
 
     def is_expire_marker(self, queue):
         """Check if the queue is an expiration marker."""
 
-        return queue.startswith('expire.bind.')
+        return queue.startswith(('expire.bind.', 'expire.bucket.'))
 
     # Serialization.
 
     def serialize(self, message):
         """Serialize message."""
 
-        value = msgpack.packb(message, use_bin_type=True)
-        if self.crypter:
-            value = self.crypter.encrypt(value)
-        return value
+        return serialize(message, self.crypter)
 
     def deserialize(self, message):
         """Deserialize message."""
 
-        if self.crypter:
-            message = self.crypter.decrypt(message, self.expiry + 10)
-        return msgpack.unpackb(message, encoding='utf8')
+        return deserialize(message, self.crypter, self.expiry)
 
 
 class LayerChannel(Channel):
@@ -539,10 +2111,47 @@ class LayerChannel(Channel):
         # Will be set in the connection wrapper process method.
         # Usually point to the corresponding protocol method.
         self.on_callback_error_callback = None
+        # Callbacks of the pipelined get requests in flight.
+        self.get_callbacks = deque()
+        # Callbacks of the pipelined unbind requests in flight.
+        self.unbind_callbacks = deque()
         super(LayerChannel, self).__init__(*args, **kwargs)
 
+    def pipeline_get(self, callback, empty_callback, queue='',
+                     no_ack=False):
+        """
+        Get a single message like `basic_get` does.  Unlike it, allows
+        many requests in flight.  Broker answers them in order, so we
+        call `callback` or `empty_callback` of the oldest request on
+        each answer.
+        """
+
+        self.get_callbacks.append((callback, empty_callback))
+        self._send_method(Basic.Get(queue=queue, no_ack=no_ack))
+
+    def pipeline_unbind(self, callback=None, queue='', exchange=None,
+                        routing_key=None, arguments=None):
+        """
+        Unbind a queue like `queue_unbind` does.  Unlike it, allows
+        many requests in flight.  Broker answers them in order, so we
+        call `callback` of the oldest request on each answer.
+        """
+
+        if routing_key is None:
+            routing_key = queue
+        self.unbind_callbacks.append(callback)
+        self._send_method(Queue.Unbind(0, queue, exchange, routing_key,
+                                       arguments or {}))
+
+    def _add_callbacks(self):
+
+        super(LayerChannel, self)._add_callbacks()
+        self.callbacks.add(self.channel_number, Queue.UnbindOk,
+                           self._on_unbindok, False)
+
     # Errors of the AMQP channel level are likely to happens in
-    # `_on_deliver`, `_on_getok` and `_on_close` methods.
+    # `_on_deliver`, `_on_getok`, `_on_getempty` and `_on_close`
+    # methods.
 
     def _on_deliver(self, method_frame, header_frame, body):
 
@@ -556,8 +2165,35 @@ class LayerChannel(Channel):
     def _on_getok(self, method_frame, header_frame, body):
 
         try:
-            super(LayerChannel, self)._on_getok(method_frame, header_frame,
-                                                body)
+            if self.get_callbacks:
+                callback, _ = self.get_callbacks.popleft()
+                callback(self, method_frame.method, header_frame.properties,
+                         body)
+            else:
+                super(LayerChannel, self)._on_getok(method_frame,
+                                                    header_frame, body)
+        except Exception as error:
+            if self.on_callback_error_callback:
+                self.on_callback_error_callback(error)
+
+    def _on_getempty(self, method_frame):
+
+        try:
+            if self.get_callbacks:
+                _, empty_callback = self.get_callbacks.popleft()
+                empty_callback(method_frame)
+            else:
+                super(LayerChannel, self)._on_getempty(method_frame)
+        except Exception as error:
+            if self.on_callback_error_callback:
+                self.on_callback_error_callback(error)
+
+    def _on_unbindok(self, method_frame):
+
+        try:
+            callback = self.unbind_callbacks.popleft()
+            if callback:
+                callback(method_frame)
         except Exception as error:
             if self.on_callback_error_callback:
                 self.on_callback_error_callback(error)
@@ -574,6 +2210,18 @@ class LayerChannel(Channel):
             )
 
 
+class LayerTimer(object):
+    """Event loop timer which may be added from any thread."""
+
+    def __init__(self, deadline, callback):
+
+        self.deadline = deadline
+        self.callback = callback
+        # Pika timeout id.  Set when event loop starts the timer.
+        self.timeout_id = None
+        self.removed = False
+
+
 class LayerConnection(SelectConnection):
     """
     `pika.Connection` wrapper with multi-thread access support and
@@ -588,7 +2236,84 @@ class LayerConnection(SelectConnection):
             'on_callback_error_callback',
         )
         self.lock = kwargs.pop('lock')
+        # Event loop thread.  Set when the loop starts.
+        self.loop_ident = None
+        # Calls made by other threads waiting for the event loop.
+        self.loop_calls = deque()
+        # Other threads wake up event loop poll with this socket pair.
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
         super(LayerConnection, self).__init__(*args, **kwargs)
+        self.ioloop.add_handler(self.wake_reader.fileno(), self.on_wake,
+                                READ)
+
+    def add_timeout(self, deadline, callback_method):
+        """
+        Add timer to the event loop.  Pika timers aren't thread safe
+        and poll doesn't notice timers added by other threads, so the
+        event loop starts them itself.
+        """
+
+        timer = LayerTimer(time.time() + deadline, callback_method)
+        self.call_in_loop(self.start_timer, timer)
+        return timer
+
+    def remove_timeout(self, timeout_id):
+        """Remove timer from the event loop."""
+
+        self.call_in_loop(self.stop_timer, timeout_id)
+
+    def start_timer(self, timer):
+
+        if not timer.removed:
+            timer.timeout_id = super(LayerConnection, self).add_timeout(
+                max(timer.deadline - time.time(), 0),
+                timer.callback,
+            )
+
+    def stop_timer(self, timer):
+
+        timer.removed = True
+        if timer.timeout_id is not None:
+            super(LayerConnection, self).remove_timeout(timer.timeout_id)
+            timer.timeout_id = None
+
+    def call_in_loop(self, f, *args):
+        """
+        Call `f` in the event loop thread.  Calls of other threads are
+        queued and the loop is woken up to make them.
+        """
+
+        if get_ident() == self.loop_ident:
+            f(*args)
+            return
+        self.loop_calls.append(partial(f, *args))
+        try:
+            self.wake_writer.send(b'x')
+        except socket.error:
+            # Socket buffer is full, so the loop will wake up anyway.
+            pass
+
+    def on_wake(self, fileno, events):
+        """Event loop was woken up by other thread.  Make its calls."""
+
+        try:
+            while self.wake_reader.recv(512):
+                pass
+        except socket.error:
+            pass
+        while self.loop_calls:
+            self.loop_calls.popleft()()
+
+    def run_loop(self):
+        """Run event loop in the current thread."""
+
+        self.loop_ident = get_ident()
+        try:
+            self.ioloop.start()
+        finally:
+            self.loop_ident = None
 
     def _process_frame(self, frame_value):
 
@@ -623,16 +2348,30 @@ class RabbitmqConnection(object):
     Connection = LayerConnection
     Protocol = Protocol
 
-    def __init__(self, url, expiry, group_expiry, get_capacity, crypter):
+    def __init__(self, url, expiry, group_expiry, get_capacity, crypter,
+                 timeout=None, pool_size=4, **options):
 
         self.url = url
         self.expiry = expiry
         self.group_expiry = group_expiry
         self.get_capacity = get_capacity
         self.crypter = crypter
+        # Default time limit of the scheduled method.
+        self.timeout = timeout
+        # Additional protocol options.
+        self.options = options
 
         # Thread to protocol instance mapping.
         self.protocols = {}
+        # Idle protocol instances used for Twisted receive and asyncio
+        # layer and busy ones by method future.
+        self.pool = []
+        self.pool_size = pool_size
+        self.in_flight = {}
+        # Queues and exchanges declared by all protocol instances.
+        self.topology = Topology()
+        # Partially received chunked messages.
+        self.chunks = Chunks()
         # Connection access lock.
         self.lock = Lock()
         # Connection startup event.
@@ -650,7 +2389,7 @@ class RabbitmqConnection(object):
     def run(self):
         """Start connection event loop."""
 
-        self.connection.ioloop.start()
+        self.connection.run_loop()
 
     def start_loop(self, connection):
         """Connection open callback."""
@@ -675,8 +2414,11 @@ class RabbitmqConnection(object):
         connection event loop.
         """
 
-        for protocol in self.protocols.values():
-            protocol.resolve.set_exception(error)
+        protocols = set(self.protocols.values())
+        protocols.update(self.pool)
+        protocols.update(self.in_flight.values())
+        for protocol in protocols:
+            protocol.protocol_error(error)
 
     def process(self, ident, method, future):
         """
@@ -684,12 +2426,20 @@ class RabbitmqConnection(object):
         one if necessary.
         """
 
-        if (ident in self.protocols and
-                self.protocols[ident].amqp_channel.is_open):
+        protocol = self.protocols.get(ident)
+        if protocol is not None and protocol.poisoned:
+            # Previous method was timed out.  Start from scratch.
+            protocol = None
+        if protocol is not None and protocol.amqp_channel is None:
+            # AMQP channel for the given thread is opening right now.
+            # Protocol method will be called after it.
+            protocol.backlog.append((method, future))
+            return
+        if protocol is not None and protocol.amqp_channel.is_open:
             # We have running AMQP channel for current given thread.
             # Apply protocol method directly.
-            self.protocols[ident].resolve = future
-            self.protocols[ident].apply(*method)
+            protocol.resolve = future
+            protocol.apply(*method)
             return
         # Given thread doesn't have corresponding protocol instance.
         # Start new AMQP channel for it and wrap it into protocol
@@ -706,14 +2456,27 @@ class RabbitmqConnection(object):
         """
 
         protocol = self.Protocol(self.expiry, self.group_expiry,
-                                 self.get_capacity, self.crypter, future)
+                                 self.get_capacity, self.crypter, future,
+                                 topology=self.topology, chunks=self.chunks,
+                                 **self.options)
         amqp_channel = self.connection.channel(
             partial(protocol.register_channel, method),
         )
         # Handle AMQP channel level errors with protocol.
         amqp_channel.on_callback_error_callback = protocol.protocol_error
+        amqp_channel.add_on_close_callback(self.channel_closed)
         return protocol
 
+    def channel_closed(self, amqp_channel, reply_code, reply_text):
+        """
+        AMQP channel close callback.  Channel closed by the broker means
+        something we know about its queues and exchanges is wrong.  For
+        example, it was 404 error.
+        """
+
+        if reply_code not in (0, 200):
+            self.topology.invalidate()
+
     def wait_open(self):
         """Wait for connection to start."""
 
@@ -730,17 +2493,46 @@ class RabbitmqConnection(object):
         thread.
         """
 
+        timeout = kwargs.pop('timeout', None)
+        if timeout is None:
+            timeout = self.timeout
         self.wait_open()
         # RabbitMQ operations are multiplexed between different AMQP
         # method callbacks.  Final result of the protocol method call
         # will be set inside one of this callbacks.  So other thread
         # will be able to wait unless this event happens in the
-        # connection event loop.
+        # connection event loop.  Caller can't cancel it, since only
+        # the event loop may resolve it.
         future = Future()
+        future.set_running_or_notify_cancel()
+        ident = get_ident()
         with self.lock:
-            self.process(get_ident(), (f, args, kwargs), future)
+            self.process(ident, (f, args, kwargs), future)
+            if timeout is not None and not future.done():
+                self.start_timer(self.protocols[ident], future, timeout)
         return future
 
+    def start_timer(self, protocol, future, timeout):
+        """Expire scheduled method if it isn't finished in time."""
+
+        timer = self.connection.add_timeout(
+            timeout,
+            partial(self.expire, protocol, future),
+        )
+        future.add_done_callback(
+            lambda future: self.connection.remove_timeout(timer),
+        )
+
+    def expire(self, protocol, future):
+        """
+        Method timer callback.  Timers are called outside of the frame
+        processing, so we need to take connection lock.
+        """
+
+        with self.lock:
+            if not future.done():
+                protocol.expire(future)
+
     @property
     def thread_protocol(self):
         """
@@ -750,18 +2542,102 @@ class RabbitmqConnection(object):
 
         return self.protocols[get_ident()]
 
-    def twisted_schedule(self, f, *args, **kwargs):
+    def pool_schedule(self, f, *args, **kwargs):
         """
-        Try to acquire connection access lock.  Then create new protocol
-        instance for one Twisted deferred object resolution.
+        Try to acquire connection access lock.  Then take idle protocol
+        instance from the pool for one method call.  Create new one if
+        pool is empty.  Unlike `schedule`, many calls from one thread
+        may be in progress at the same time.
         """
 
+        timeout = kwargs.pop('timeout', None)
+        if timeout is None:
+            timeout = self.timeout
         self.wait_open()
         future = Future()
+        # Only the event loop resolves the future.  Cancel the method
+        # with `cancel` instead.
+        future.set_running_or_notify_cancel()
         with self.lock:
-            self.open_amqp_channel((f, args, kwargs), future)
+            channels = args[0] if f in (RECEIVE, RECEIVE_BATCH,
+                                        RECEIVE_TWISTED) else ()
+            protocol = self.take_pooled_protocol(channels)
+            if protocol is not None:
+                protocol.resolve = future
+                protocol.apply(f, args, kwargs)
+            else:
+                protocol = self.open_amqp_channel((f, args, kwargs), future)
+            if not future.done():
+                self.in_flight[future] = protocol
+            future.add_done_callback(
+                partial(self.release_pooled_protocol, protocol),
+            )
+            if timeout is not None and not future.done():
+                self.start_timer(protocol, future, timeout)
         return future
 
+    def twisted_schedule(self, f, *args, **kwargs):
+        """
+        Schedule method with pooled protocol instance for one Twisted
+        deferred object resolution.
+        """
+
+        return self.pool_schedule(f, *args, **kwargs)
+
+    def cancel(self, future):
+        """
+        Caller doesn't wait for the pooled method anymore.  Stop it if
+        it is a receive.  Protocol returns to the pool when method
+        future is resolved.
+        """
+
+        with self.lock:
+            protocol = self.in_flight.get(future)
+            if protocol is not None and not future.done():
+                protocol.cancel(future)
+
+    def take_pooled_protocol(self, channels=()):
+        """
+        Take idle protocol with open AMQP channel from the pool.  Prefer
+        one with persistent consumers of exactly these `channels`, then
+        one without consumers.  Receive cancels consumers of other
+        channels itself.
+        """
+
+        self.pool = [protocol for protocol in self.pool
+                     if protocol.amqp_channel.is_open]
+        if not self.pool:
+            return None
+        channels = set(channels)
+        found = [index for index, protocol in enumerate(self.pool)
+                 if set(protocol.consumers) == channels]
+        if not found:
+            found = [index for index, protocol in enumerate(self.pool)
+                     if not protocol.consumers]
+        return self.pool.pop(found[-1] if found else -1)
+
+    def release_pooled_protocol(self, protocol, future):
+        """
+        Method future was resolved.  Return protocol to the pool with
+        its persistent consumers or close its AMQP channel if pool is
+        full.  Broker requeues messages it holds in the last case.
+        Called from the event loop, so connection lock is already taken.
+        """
+
+        self.in_flight.pop(future, None)
+        amqp_channel = protocol.amqp_channel
+        if amqp_channel is None:
+            # Channel is still opening.  Close it as soon as it opens.
+            protocol.poisoned = True
+        elif not amqp_channel.is_open:
+            return
+        else:
+            protocol.flush_acks()
+            if not protocol.poisoned and len(self.pool) < self.pool_size:
+                self.pool.append(protocol)
+            else:
+                amqp_channel.close()
+
 
 class ConnectionThread(Thread):
     """
@@ -772,12 +2648,13 @@ class ConnectionThread(Thread):
 
     Connection = RabbitmqConnection
 
-    def __init__(self, url, expiry, group_expiry, get_capacity, crypter):
+    def __init__(self, url, expiry, group_expiry, get_capacity, crypter,
+                 **options):
 
         super(ConnectionThread, self).__init__()
         self.daemon = True
         self.connection = self.Connection(url, expiry, group_expiry,
-                                          get_capacity, crypter)
+                                          get_capacity, crypter, **options)
 
     def run(self):
         """Start connection thread."""
@@ -799,9 +2676,21 @@ class ConnectionThread(Thread):
         in the end.
         """
 
-        # FIXME: Close AMQP channels opened by twisted.
         return self.connection.twisted_schedule(f, *args, **kwargs)
 
+    def pool_schedule(self, f, *args, **kwargs):
+        """
+        Schedule protocol method execution in the context of the
+        connection thread with its own AMQP channel.
+        """
+
+        return self.connection.pool_schedule(f, *args, **kwargs)
+
+    def cancel(self, future):
+        """Stop pooled method if it is possible."""
+
+        return self.connection.cancel(future)
+
 
 class RabbitmqChannelLayer(BaseChannelLayer):
     """
@@ -816,13 +2705,34 @@ class RabbitmqChannelLayer(BaseChannelLayer):
 
     Thread = ConnectionThread
 
+    class Timeout(Exception):
+        """Operation wasn't finished in time."""
+
     def __init__(self,
                  url,
                  expiry=60,
                  group_expiry=86400,
                  capacity=100,
                  channel_capacity=None,
-                 symmetric_encryption_keys=None):
+                 symmetric_encryption_keys=None,
+                 broker_capacity=False,
+                 publisher_confirms=False,
+                 chunk_size=None,
+                 prefetch_count=None,
+                 ack_policy='immediate',
+                 ack_batch=10,
+                 ack_interval=0.1,
+                 receive_policy='ordered',
+                 channel_priority=None,
+                 timeout=None,
+                 pool_size=4,
+                 pipeline_group_add=False,
+                 empty_group_ttl=None,
+                 group_expiry_buckets=None,
+                 group_refresh_window=None,
+                 direct_local_groups=False,
+                 group_routing='exchange',
+                 queue_length_cache=False):
 
         super(RabbitmqChannelLayer, self).__init__(
             expiry=expiry,
@@ -830,6 +2740,24 @@ class RabbitmqChannelLayer(BaseChannelLayer):
             capacity=capacity,
             channel_capacity=channel_capacity,
         )
+        # Channel capacity regexp matching is done once per channel
+        # name.
+        self.names = ChannelNames(
+            super(RabbitmqChannelLayer, self).get_capacity,
+        )
+        if ack_policy not in ('immediate', 'coalesced', 'none'):
+            raise ValueError('Unknown ack policy %s' % ack_policy)
+        if receive_policy not in ReceiveScheduler.policies:
+            raise ValueError('Unknown receive policy %s' % receive_policy)
+        if group_routing not in ('exchange', 'direct'):
+            raise ValueError('Unknown group routing %s' % group_routing)
+        if (group_expiry_buckets and
+                group_expiry_buckets > MAX_EXPIRY_BUCKETS):
+            raise ValueError('Group expiry buckets should not exceed %d'
+                             % MAX_EXPIRY_BUCKETS)
+        if group_refresh_window and group_refresh_window >= group_expiry:
+            raise ValueError('Group refresh window should be shorter '
+                             'than group expiry')
         if symmetric_encryption_keys:
             try:
                 from cryptography.fernet import MultiFernet
@@ -841,9 +2769,34 @@ class RabbitmqChannelLayer(BaseChannelLayer):
             crypter = MultiFernet(sub_fernets)
         else:
             crypter = None
+        self.crypter = crypter
+        self.chunk_size = chunk_size
         # Connection thread will be started on first method access.
-        self._thread = self.Thread(url, expiry, group_expiry,
-                                   self.get_capacity, crypter)
+        self._thread = self.Thread(
+            url,
+            expiry,
+            group_expiry,
+            self.get_capacity,
+            crypter,
+            names=self.names,
+            broker_capacity=broker_capacity,
+            publisher_confirms=publisher_confirms,
+            prefetch_count=prefetch_count,
+            ack_policy=ack_policy,
+            ack_batch=ack_batch,
+            ack_interval=ack_interval,
+            receive_policy=receive_policy,
+            channel_priority=self.compile_capacities(channel_priority or {}),
+            timeout=timeout,
+            pool_size=pool_size,
+            pipeline_group_add=pipeline_group_add,
+            empty_group_ttl=empty_group_ttl,
+            group_expiry_buckets=group_expiry_buckets,
+            group_refresh_window=group_refresh_window,
+            direct_local_groups=direct_local_groups,
+            group_routing=group_routing,
+            queue_length_cache=queue_length_cache,
+        )
 
     @threaded_cached_property
     def thread(self):
@@ -855,6 +2808,21 @@ class RabbitmqChannelLayer(BaseChannelLayer):
         self._thread.start()
         return self._thread
 
+    def get_capacity(self, channel):
+        """Get memoized capacity of the channel."""
+
+        return self.names.capacity(channel)
+
+    def serialize(self, message):
+        """Serialize message."""
+
+        return serialize(message, self.crypter)
+
+    def deserialize(self, message):
+        """Deserialize message."""
+
+        return deserialize(message, self.crypter, self.expiry)
+
     def make_fernet(self, key):
         """
         Given a single encryption key, returns a Fernet instance using it.
@@ -865,60 +2833,212 @@ class RabbitmqChannelLayer(BaseChannelLayer):
         formatted_key = base64.urlsafe_b64encode(hashlib.sha256(key).digest())
         return Fernet(formatted_key)
 
-    def send(self, channel, message):
+    def send(self, channel, message, timeout=None):
         """Send the message to the channel."""
 
+        return self.send_async(channel, message, timeout=timeout).result()
+
+    def send_async(self, channel, message, forget=False, timeout=None):
+        """
+        Send the message to the channel without waiting for the result.
+        Return future resolved when message was sent.  If `forget` is
+        set, return `None` and ignore any errors.  Future fails with
+        `Timeout` error if message wasn't sent in `timeout` seconds and
+        with `MessageTooLarge` if message has more chunks than channel
+        capacity.
+        """
+
         assert self.valid_channel_name(channel), 'Channel name is not valid'
-        future = self.thread.schedule(SEND, channel, message)
+        # Keep CPU bound work out of the connection thread.
+        body = self.serialize(message)
+        chunks = None
+        if self.should_split(channel, body):
+            chunks = self.split(body)
+        if chunks and len(chunks) > self.get_capacity(channel):
+            # Each chunk takes a place in the channel queue.  This
+            # message will never fit there.
+            future = Future()
+            future.set_exception(self.MessageTooLarge())
+        elif chunks:
+            future = self.thread.schedule(SEND_CHUNKS, channel,
+                                          uuid.uuid4().hex, chunks,
+                                          timeout=timeout)
+        else:
+            future = self.thread.schedule(SEND, channel, body,
+                                          timeout=timeout)
+        if forget:
+            return None
+        return future
+
+    def should_split(self, channel, body):
+        """
+        Check if message body should be sent in chunks.  Only single
+        reader and process local channels support it, since chunks of
+        one message must be received by one process.
+        """
+
+        return (self.chunk_size is not None and
+                len(body) > self.chunk_size and
+                self.names.is_remote(channel))
+
+    def split(self, body):
+        """Split message body into chunks."""
+
+        return [
+            body[start:start + self.chunk_size]
+            for start in range(0, len(body), self.chunk_size)
+        ]
+
+    def send_many(self, pairs, timeout=None):
+        """
+        Send many messages in one pass.  Messages are serialized in the
+        calling thread.  Return list with `None` for each sent message
+        and `ChannelFull` error for each message which doesn't fit into
+        channel capacity.
+        """
+
+        batch = []
+        for channel, message in pairs:
+            fail_msg = 'Channel name %s is not valid' % channel
+            assert self.valid_channel_name(channel), fail_msg
+            batch.append((channel, self.serialize(message)))
+        if not batch:
+            return []
+        future = self.thread.schedule(SEND_MANY, batch, timeout=timeout)
         return future.result()
 
-    def receive(self, channels, block=False):
-        """Receive one message from one of the channels."""
+    def receive(self, channels, block=False, timeout=None):
+        """
+        Receive one message from one of the channels.  Blocking receive
+        returns `(None, None)` if there were no messages in `timeout`
+        seconds.
+        """
 
         for channel in channels:
             fail_msg = 'Channel name %s is not valid' % channel
             assert self.valid_channel_name(channel, receive=True), fail_msg
-        future = self.thread.schedule(RECEIVE, channels, block)
-        return future.result()
+        future = self.thread.schedule(RECEIVE, channels, block,
+                                      timeout=timeout)
+        return self.received(future.result())
+
+    def receive_batch(self, channels, max_messages=10, timeout=None):
+        """
+        Receive up to `max_messages` messages from the channels in one
+        pass.  If there are no messages, wait for the first one up to
+        `timeout` seconds.  Return list of `(channel, message)` pairs.
+        """
 
-    def new_channel(self, pattern):
+        for channel in channels:
+            fail_msg = 'Channel name %s is not valid' % channel
+            assert self.valid_channel_name(channel, receive=True), fail_msg
+        future = self.thread.schedule(RECEIVE_BATCH, channels, max_messages,
+                                      timeout, timeout=timeout)
+        return [self.received(result) for result in future.result()]
+
+    def received(self, result):
+        """Deserialize message body received by the connection thread."""
+
+        channel, body = result
+        if channel is None:
+            return None, None
+        return channel, self.deserialize(body)
+
+    def new_channel(self, pattern, timeout=None):
         """Create new single reader channel."""
 
         assert pattern.endswith('?')
         random_string = "".join(random.choice(ASCII) for i in range(20))
         new_name = pattern + random_string
-        future = self.thread.schedule(NEW_CHANNEL, new_name)
+        future = self.thread.schedule(NEW_CHANNEL, new_name, timeout=timeout)
         future.result()
         return new_name
 
-    def group_add(self, group, channel):
+    def group_add(self, group, channel, timeout=None):
         """Add channel to the group."""
 
         assert self.valid_group_name(group), 'Group name is not valid'
         assert self.valid_channel_name(channel), 'Channel name is not valid'
-        future = self.thread.schedule(GROUP_ADD, group, channel)
+        future = self.thread.schedule(GROUP_ADD, group, channel,
+                                      timeout=timeout)
         return future.result()
 
-    def group_discard(self, group, channel):
+    def group_discard(self, group, channel, timeout=None):
         """Remove the channel from the group."""
 
         assert self.valid_group_name(group), 'Group name is not valid'
         assert self.valid_channel_name(channel), 'Channel name is not valid'
-        future = self.thread.schedule(GROUP_DISCARD, group, channel)
+        future = self.thread.schedule(GROUP_DISCARD, group, channel,
+                                      timeout=timeout)
+        return future.result()
+
+    def group_add_many(self, pairs, timeout=None):
+        """
+        Add channels to groups in one pass.  Takes list of `(group,
+        channel)` pairs.  Each group and each channel is declared once.
+        """
+
+        memberships = self.memberships(pairs)
+        future = self.thread.schedule(GROUP_ADD_MANY, memberships,
+                                      timeout=timeout)
+        return future.result()
+
+    def group_discard_many(self, pairs, timeout=None):
+        """
+        Remove channels from groups in one pass.  Takes list of `(group,
+        channel)` pairs.
+        """
+
+        memberships = self.memberships(pairs)
+        future = self.thread.schedule(GROUP_DISCARD_MANY, memberships,
+                                      timeout=timeout)
         return future.result()
 
-    def send_group(self, group, message):
+    def memberships(self, pairs):
+        """Validate `(group, channel)` pairs of the bulk group methods."""
+
+        memberships = []
+        for group, channel in pairs:
+            assert self.valid_group_name(group), 'Group name is not valid'
+            fail_msg = 'Channel name %s is not valid' % channel
+            assert self.valid_channel_name(channel), fail_msg
+            memberships.append((group, channel))
+        return memberships
+
+    def send_group(self, group, message, timeout=None):
         """Send the message to the group."""
 
+        return self.send_group_async(group, message,
+                                     timeout=timeout).result()
+
+    def send_group_async(self, group, message, forget=False, timeout=None):
+        """
+        Send the message to the group without waiting for the result.
+        Return future resolved when message was sent.  If `forget` is
+        set, return `None` and ignore any errors.
+        """
+
         assert self.valid_group_name(group), 'Group name is not valid'
-        future = self.thread.schedule(SEND_GROUP, group, message)
+        body = self.serialize(message)
+        future = self.thread.schedule(SEND_GROUP, group, body,
+                                      timeout=timeout)
+        if forget:
+            return None
+        result = Future()
+        future.add_done_callback(partial(self.group_sent, result))
+        return result
+
+    def group_sent(self, result, future):
+        """Pass result of the group send to the future returned to user."""
+
         try:
-            return future.result()
+            result.set_result(future.result())
         except ChannelClosed:
             # Channel was closed because corresponding group exchange
             # does not exist yet.  This mean no one call `group_add`
             # yet, so group is empty and we should not worry about.
-            pass
+            result.set_result(None)
+        except Exception as error:
+            result.set_exception(error)
 
     if TWISTED_AVAILABLE:
 
@@ -936,9 +3056,7 @@ class RabbitmqChannelLayer(BaseChannelLayer):
 
             future = self.thread.twisted_schedule(RECEIVE_TWISTED, channels)
             future.add_done_callback(resolve_deferred)
+            # Decode message in the reactor thread instead of the
+            # connection thread.
+            deferred.addCallback(self.received)
             defer.returnValue((yield deferred))
-
-
-# TODO: Is it optimal to read bytes from content frame, call python
-# decode method to convert it to string and than parse it with
-# msgpack?  We should minimize useless work on message receive.
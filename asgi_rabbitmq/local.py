@@ -1,4 +1,6 @@
-from .core import RabbitmqChannelLayer
+import time
+
+from .core import Future, RabbitmqChannelLayer, monotonic
 
 
 class RabbitmqLocalChannelLayer(RabbitmqChannelLayer):
@@ -15,6 +17,10 @@ class RabbitmqLocalChannelLayer(RabbitmqChannelLayer):
     reply_channel names valid across all workers.
     """
 
+    # Time in seconds between local channel checks of the waiting
+    # batch receive.
+    poll_interval = 0.1
+
     def __init__(self,
                  url,
                  expiry=60,
@@ -22,7 +28,8 @@ class RabbitmqLocalChannelLayer(RabbitmqChannelLayer):
                  capacity=100,
                  channel_capacity=None,
                  symmetric_encryption_keys=None,
-                 prefix='asgi'):
+                 prefix='asgi',
+                 **options):
 
         # Initialise the base class.
         super(RabbitmqLocalChannelLayer, self).__init__(
@@ -32,6 +39,7 @@ class RabbitmqLocalChannelLayer(RabbitmqChannelLayer):
             capacity=capacity,
             channel_capacity=channel_capacity,
             symmetric_encryption_keys=symmetric_encryption_keys,
+            **options
         )
         # Set up our local transport layer as well.
         try:
@@ -48,24 +56,69 @@ class RabbitmqLocalChannelLayer(RabbitmqChannelLayer):
             channel_capacity=channel_capacity,
         )
 
-    def send(self, channel, message):
+    def send(self, channel, message, timeout=None):
         """Send the message to the channel."""
 
         # If the channel is "normal", use IPC layer, otherwise use
         # RabbitMQ layer.
-        if "!" in channel or "?" in channel:
+        if self.names.is_remote(channel):
             return super(RabbitmqLocalChannelLayer, self).send(
                 channel,
                 message,
+                timeout,
             )
         else:
             return self.local_layer.send(channel, message)
 
-    def receive(self, channels, block=False):
+    def send_async(self, channel, message, forget=False, timeout=None):
+        """Send the message to the channel without waiting for the result."""
+
+        if self.names.is_remote(channel):
+            return super(RabbitmqLocalChannelLayer, self).send_async(
+                channel,
+                message,
+                forget,
+                timeout,
+            )
+        # IPC layer is synchronous.  Return already resolved future.
+        future = Future()
+        try:
+            future.set_result(self.local_layer.send(channel, message))
+        except self.ChannelFull as error:
+            future.set_exception(error)
+        if forget:
+            return None
+        return future
+
+    def send_many(self, pairs, timeout=None):
+        """Send many messages in one pass."""
+
+        # Send "normal" channels with IPC layer one by one.  Send all
+        # other channels with RabbitMQ layer in one batch.
+        pairs = list(pairs)
+        results = [None] * len(pairs)
+        remote = []
+        for index, (channel, message) in enumerate(pairs):
+            if self.names.is_remote(channel):
+                remote.append(index)
+                continue
+            try:
+                self.local_layer.send(channel, message)
+            except self.ChannelFull as error:
+                results[index] = error
+        sent = super(RabbitmqLocalChannelLayer, self).send_many(
+            [pairs[index] for index in remote],
+            timeout,
+        )
+        for index, result in zip(remote, sent):
+            results[index] = result
+        return results
+
+    def receive(self, channels, block=False, timeout=None):
         """Receive one message from one of the channels."""
 
         # Work out what kinds of channels are in there.
-        num_remote = len([ch for ch in channels if "!" in ch or "?" in ch])
+        num_remote = len([ch for ch in channels if self.names.is_remote(ch)])
         num_local = len(channels) - num_remote
         # If they mixed types, force nonblock mode and query both
         # backends, local first.
@@ -76,6 +129,7 @@ class RabbitmqLocalChannelLayer(RabbitmqChannelLayer):
             return super(RabbitmqLocalChannelLayer, self).receive(
                 channels,
                 block,
+                timeout,
             )
         # If they just did one type, pass off to that backend.
         elif num_local:
@@ -84,7 +138,56 @@ class RabbitmqLocalChannelLayer(RabbitmqChannelLayer):
             return super(RabbitmqLocalChannelLayer, self).receive(
                 channels,
                 block,
+                timeout,
+            )
+
+    def receive_batch(self, channels, max_messages=10, timeout=None):
+        """
+        Receive up to `max_messages` messages from the channels.  If
+        there are no messages, wait for the first one up to `timeout`
+        seconds.
+        """
+
+        if all(self.names.is_remote(channel) for channel in channels):
+            return super(RabbitmqLocalChannelLayer, self).receive_batch(
+                channels,
+                max_messages,
+                timeout,
+            )
+        # IPC layer can't receive many messages at once.  Receive them
+        # one by one without waiting.
+        messages = []
+        while len(messages) < max_messages:
+            channel, message = self.receive(channels, block=False)
+            if channel is None:
+                break
+            messages.append((channel, message))
+        if messages or not timeout:
+            return messages
+        # IPC layer can't wait with timeout.  Check local channels
+        # between short waits on the remote ones.
+        local = [channel for channel in channels
+                 if not self.names.is_remote(channel)]
+        remote = [channel for channel in channels
+                  if self.names.is_remote(channel)]
+        deadline = monotonic() + timeout
+        while True:
+            channel, message = self.local_layer.receive(local, block=False)
+            if channel is not None:
+                return [(channel, message)]
+            wait = min(deadline - monotonic(), self.poll_interval)
+            if wait <= 0:
+                return []
+            if not remote:
+                time.sleep(wait)
+                continue
+            channel, message = super(RabbitmqLocalChannelLayer, self).receive(
+                remote,
+                True,
+                wait,
             )
+            if channel is not None:
+                return [(channel, message)]
 
     # `new_channel` always goes to RabbitMQ as it's always remote
     # channels.  Group APIs always go to RabbitMQ too.
@@ -17,7 +17,7 @@ setup(
     install_requires=[
         'pika~=0.11.0',
         'asgiref~=1.1.2',
-        'msgpack-python',
+        'msgpack-python>=0.5.2',
         'cached-property',
         'futures ; python_version < "3.0"',
     ],
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import sys
 import threading
 import time
 from collections import defaultdict
@@ -9,9 +10,15 @@ import pytest
 from asgi_rabbitmq import RabbitmqChannelLayer, RabbitmqLocalChannelLayer
 from asgi_rabbitmq.core import (
     EXPIRE_GROUP_MEMBER,
+    RECEIVE,
+    SEND,
+    ChannelNames,
+    Chunks,
     ConnectionThread,
     Protocol,
     RabbitmqConnection,
+    ReceiveScheduler,
+    deserialize,
 )
 from asgi_rabbitmq.test import RabbitmqLayerTestCaseMixin
 from asgiref.conformance import ConformanceTestCase
@@ -554,6 +561,901 @@ class RabbitmqChannelLayerTest(SetupMixin, RabbitmqLayerTestCaseMixin,
         assert channel is None
         assert message is None
 
+    def test_declared_queues_cache(self):
+        """
+        We remember declared queues with its length.  We forget them when
+        broker closes AMQP channel.
+        """
+
+        topology = self.channel_layer.thread.connection.topology
+        name = self.channel_layer.new_channel('dq.foo?')
+        self.channel_layer.send(name, {'bar': 'baz'})
+        self.channel_layer.send(name, {'bar': 'baz'})
+        assert topology.queues.get(name) == 2
+        self.channel_layer.thread.connection.channel_closed(
+            None, 404, 'NOT_FOUND')
+        assert name not in topology.queues
+        self.channel_layer.send(name, {'bar': 'baz'})
+        assert topology.queues.get(name) == 3
+
+    def test_queue_length_cache(self):
+        """
+        By default queue length is checked before each publish.  With
+        queue length cache publishes of other producers aren't counted.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            queue_length_cache=True,
+        )
+        name = layer.new_channel('ql.foo?')
+        layer.send(name, {'bar': 'baz'})
+        for _ in range(self.capacity_limit - 1):
+            self.channel_layer.send(name, {'bar': 'baz'})
+        layer.send(name, {'bar': 'baz'})
+        with pytest.raises(self.channel_layer.ChannelFull):
+            self.channel_layer.send(name, {'bar': 'baz'})
+
+    def test_broker_capacity(self):
+        """
+        Broker can check channel capacity itself.  Rejected message
+        raises ChannelFull error.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            channel_capacity={'bc.http.request?*': 10},
+            broker_capacity=True,
+        )
+        name = layer.new_channel('bc.foo?')
+        request = layer.new_channel('bc.http.request?')
+        for _ in range(self.capacity_limit):
+            layer.send(name, {'hey': 'there'})
+        with pytest.raises(self.channel_layer.ChannelFull):
+            layer.send(name, {'hey': 'there'})
+        for _ in range(10):
+            layer.send(request, {'hey': 'there'})
+        with pytest.raises(self.channel_layer.ChannelFull):
+            layer.send(request, {'hey': 'there'})
+        channel, message = layer.receive([request])
+        assert channel == request
+        assert message == {'hey': 'there'}
+        layer.send(request, {'hey': 'there'})
+
+    def test_publisher_confirms(self):
+        """Messages can be sent and received in the confirm mode."""
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            publisher_confirms=True,
+        )
+        name = layer.new_channel('pc.foo?')
+        layer.send(name, {'hey': 'there'})
+        layer.group_add('pc.group', name)
+        layer.send_group('pc.group', {'foo': 'bar'})
+        channel, message = layer.receive([name])
+        assert channel == name
+        assert message == {'hey': 'there'}
+        channel, message = layer.receive([name])
+        assert channel == name
+        assert message == {'foo': 'bar'}
+        assert not layer.thread.connection.thread_protocol.unconfirmed
+
+    def test_send_many(self):
+        """
+        We can send many messages at once.  Messages which doesn't fit
+        into channel capacity are reported in the result list.
+        """
+
+        name = self.channel_layer.new_channel('foo?')
+        pairs = [(name, {'n': n}) for n in range(self.capacity_limit + 1)]
+        pairs.append(('bar', {'n': 'bar'}))
+        results = self.channel_layer.send_many(pairs)
+        assert results[:self.capacity_limit] == [None] * self.capacity_limit
+        assert isinstance(results[-2], self.channel_layer.ChannelFull)
+        assert results[-1] is None
+        channel, message = self.channel_layer.receive([name])
+        assert channel == name
+        assert message == {'n': 0}
+        channel, message = self.channel_layer.receive(['bar'])
+        assert channel == 'bar'
+        assert message == {'n': 'bar'}
+
+    def test_send_many_confirms(self):
+        """Batch results are resolved by publisher confirms."""
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            broker_capacity=True,
+        )
+        name = layer.new_channel('smc.foo?')
+        pairs = [(name, {'n': n}) for n in range(self.capacity_limit + 1)]
+        results = layer.send_many(pairs)
+        assert results[:-1] == [None] * self.capacity_limit
+        assert isinstance(results[-1], self.channel_layer.ChannelFull)
+
+    def test_send_async(self):
+        """
+        We can schedule many messages without waiting for each of them.
+        """
+
+        name = self.channel_layer.new_channel('foo?')
+        futures = [
+            self.channel_layer.send_async(name, {'n': n})
+            for n in range(self.capacity_limit + 1)
+        ]
+        for future in futures[:-1]:
+            assert future.result() is None
+        with pytest.raises(self.channel_layer.ChannelFull):
+            futures[-1].result()
+        for n in range(self.capacity_limit):
+            channel, message = self.channel_layer.receive([name])
+            assert channel == name
+            assert message == {'n': n}
+
+    def test_send_async_cancel(self):
+        """
+        Send future can't be cancelled.  Connection thread resolves it
+        anyway.
+        """
+
+        name = self.channel_layer.new_channel('sac.foo?')
+        future = self.channel_layer.send_async(name, {'bar': 'baz'})
+        assert not future.cancel()
+        assert future.result() is None
+        assert self.channel_layer.receive([name]) == (name, {'bar': 'baz'})
+
+    def test_send_async_forget(self):
+        """We can send message without any result."""
+
+        name = self.channel_layer.new_channel('saf.foo?')
+        assert self.channel_layer.send_async(name, {'bar': 'baz'},
+                                             forget=True) is None
+        assert self.channel_layer.send_group_async('tgroup', {'x': 'y'},
+                                                   forget=True) is None
+        channel, message = self.channel_layer.receive([name], block=True)
+        assert channel == name
+        assert message == {'bar': 'baz'}
+
+    def test_send_group_async(self):
+        """Group send future is resolved for empty group too."""
+
+        future = self.channel_layer.send_group_async('tgroup', {'x': 'y'})
+        assert future.result() is None
+
+    def test_shared_publish_properties(self):
+        """
+        Message properties and queue arguments are computed once.  Only
+        process local channels need its own properties.
+        """
+
+        protocol = Protocol(1, 5, self.channel_layer.get_capacity, None,
+                            None)
+        assert (protocol.publish_properties('foo') is
+                protocol.publish_properties('bar'))
+        assert protocol.publish_properties('foo').expiration == '1000'
+        properties = protocol.publish_properties('foo!baz')
+        assert properties.headers == {'asgi_channel': 'baz'}
+        assert properties.expiration == '1000'
+        assert protocol.queue_arguments('foo') is protocol.queue_arguments(
+            'bar')
+
+    def test_channel_names(self):
+        """
+        Channel name properties are computed once.  Least recently used
+        names are forgotten first.
+        """
+
+        names = ChannelNames(lambda channel: len(channel))
+        names.size = 2
+        assert names.queue('foo.bar!baz') == 'foo.bar!'
+        assert names.capacity('foo.bar!baz') == 11
+        assert names.is_remote('foo.bar!baz')
+        assert not names.is_remote('foo')
+        assert names.is_remote('foo?bar')
+        assert list(names.names) == ['foo', 'foo?bar']
+        names.queue('foo')
+        names.queue('bar')
+        assert list(names.names) == ['foo', 'bar']
+        assert self.channel_layer.get_capacity('foo') == self.capacity_limit
+        assert 'foo' in self.channel_layer.names.names
+
+    def test_serialize_in_calling_thread(self):
+        """
+        Connection thread works with serialized message bodies only.
+        Messages are encoded and decoded in the calling thread.
+        """
+
+        body = self.channel_layer.serialize({'foo': 'bar'})
+        self.channel_layer.thread.schedule(SEND, 'foo', body).result()
+        future = self.channel_layer.thread.schedule(RECEIVE, ['foo'], False)
+        channel, received = future.result()
+        assert channel == 'foo'
+        assert received == body
+        assert deserialize(body) == {'foo': 'bar'}
+        assert self.channel_layer.received((channel, received)) == (
+            'foo', {'foo': 'bar'})
+        assert self.channel_layer.received((None, None)) == (None, None)
+
+    def test_chunked_message(self):
+        """
+        Large message sent to the single reader channel is split into
+        chunks.  Receive returns whole message.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=10,
+            chunk_size=16,
+        )
+        name = layer.new_channel('cs.foo?')
+        message = {'body': b'x' * 100}
+        layer.send(name, message)
+        layer.send(name, {'hey': 'there'})
+        assert layer.receive([name]) == (name, message)
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+        layer.send(name, message)
+        assert layer.receive([name], block=True) == (name, message)
+        assert not layer.thread.connection.chunks.messages.data
+
+    def test_chunked_message_capacity(self):
+        """
+        Each chunk takes a place in the channel queue.  Message with
+        more chunks than channel capacity is too large.  In the confirm
+        mode send waits for every chunk.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=10,
+            chunk_size=16,
+            publisher_confirms=True,
+        )
+        name = layer.new_channel('cc.foo?')
+        message = {'body': b'x' * 100}  # Seven chunks.
+        layer.send(name, message)
+        with pytest.raises(layer.ChannelFull):
+            layer.send(name, message)
+        for _ in range(3):
+            layer.send(name, {'hey': 'there'})
+        with pytest.raises(layer.ChannelFull):
+            layer.send(name, {'hey': 'there'})
+        with pytest.raises(layer.MessageTooLarge):
+            layer.send(name, {'body': b'x' * 200})
+        assert layer.receive([name]) == (name, message)
+        assert not layer.thread.connection.thread_protocol.unconfirmed
+
+    def test_chunked_message_broker_capacity(self):
+        """
+        Chunks aren't published unless queue has space for all of them
+        in the broker capacity mode.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=10,
+            chunk_size=16,
+            broker_capacity=True,
+        )
+        name = layer.new_channel('cbc.foo?')
+        message = {'body': b'x' * 100}  # Seven chunks.
+        layer.send(name, message)
+        layer.send(name, {'hey': 'there'})
+        with pytest.raises(layer.ChannelFull):
+            layer.send(name, message)
+        assert layer.receive([name]) == (name, message)
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+        assert layer.receive([name]) == (None, None)
+        assert not layer.thread.connection.chunks.messages.data
+
+    def test_persistent_consumers(self):
+        """
+        Blocking receive keeps consumers between calls.  Consumers of
+        channels thread doesn't receive from anymore are canceled.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            prefetch_count=2,
+        )
+        foo = layer.new_channel('pf.foo?')
+        bar = layer.new_channel('pf.bar?')
+        for number in range(3):
+            layer.send(foo, {'number': number})
+        layer.send(bar, {'hey': 'there'})
+        assert layer.receive([foo], block=True) == (foo, {'number': 0})
+        protocol = layer.thread.connection.thread_protocol
+        consumers = dict(protocol.consumers)
+        assert layer.receive([foo], block=True) == (foo, {'number': 1})
+        assert protocol.consumers == consumers
+        assert layer.receive([bar], block=True) == (bar, {'hey': 'there'})
+        assert list(protocol.consumers) == [bar]
+        # Message held in the inbox was returned to the queue.
+        assert layer.receive([foo]) == (foo, {'number': 2})
+
+    def test_parallel_non_blocking_receive(self):
+        """
+        Non-blocking receive checks all queues at once.  First channel
+        with a message wins.  Other messages stay in their queues.
+        """
+
+        foo = self.channel_layer.new_channel('nb.foo?')
+        bar = self.channel_layer.new_channel('nb.bar?')
+        baz = self.channel_layer.new_channel('nb.baz?')
+        self.channel_layer.send(bar, {'bar': 1})
+        self.channel_layer.send(baz, {'baz': 1})
+        channels = [foo, bar, baz]
+        assert self.channel_layer.receive(channels) == (bar, {'bar': 1})
+        assert self.channel_layer.receive(channels) == (baz, {'baz': 1})
+        assert self.channel_layer.receive(channels) == (None, None)
+        protocol = self.channel_layer.thread.connection.thread_protocol
+        assert not protocol.amqp_channel.get_callbacks
+
+    def test_coalesced_acks(self):
+        """
+        Received messages are acknowledged together on batch size or
+        timer.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            ack_policy='coalesced',
+            ack_batch=3,
+            ack_interval=0.2,
+        )
+        name = layer.new_channel('ca.foo?')
+        for number in range(4):
+            layer.send(name, {'number': number})
+        for number in range(2):
+            assert layer.receive([name]) == (name, {'number': number})
+        protocol = layer.thread.connection.thread_protocol
+        assert len(protocol.ack_tags) == 2
+        assert layer.receive([name]) == (name, {'number': 2})
+        assert not protocol.ack_tags
+        assert layer.receive([name], block=True) == (name, {'number': 3})
+        time.sleep(0.5)
+        assert not protocol.ack_tags
+        assert protocol.ack_timer is None
+
+    def test_coalesced_acks_with_receive_policy(self):
+        """
+        Message chosen by receive policy may have larger delivery tag
+        than rejected ones.  Rejected messages are returned to their
+        queues before acknowledgment.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            ack_policy='coalesced',
+            ack_batch=1,
+            receive_policy='priority',
+            channel_priority={'cap.bar?*': 2},
+        )
+        foo = layer.new_channel('cap.foo?')
+        bar = layer.new_channel('cap.bar?')
+        layer.send(foo, {'foo': 1})
+        layer.send(bar, {'bar': 1})
+        assert layer.receive([foo, bar]) == (bar, {'bar': 1})
+        assert layer.receive([foo, bar]) == (foo, {'foo': 1})
+        assert layer.receive([foo, bar]) == (None, None)
+
+    def test_coalesced_acks_with_chunked_message(self):
+        """
+        Chunks are acknowledged while the plain message with smaller
+        delivery tag is still held by the receive.  It is returned to
+        its queue after all.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=10,
+            ack_policy='coalesced',
+            ack_batch=1,
+            chunk_size=16,
+            receive_policy='priority',
+            channel_priority={'ch.bar?*': 2},
+        )
+        foo = layer.new_channel('ch.foo?')
+        bar = layer.new_channel('ch.bar?')
+        layer.send(foo, {'foo': 1})
+        layer.send(bar, {'bar': 'x' * 64})
+        assert layer.receive([foo, bar]) == (bar, {'bar': 'x' * 64})
+        assert layer.receive([foo, bar]) == (foo, {'foo': 1})
+        assert layer.receive([foo, bar]) == (None, None)
+
+    def test_no_ack_policy(self):
+        """Messages can be received without acknowledgments."""
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            ack_policy='none',
+        )
+        foo = layer.new_channel('na.foo?')
+        bar = layer.new_channel('na.bar?')
+        layer.send(foo, {'hey': 'there'})
+        layer.send(bar, {'foo': 'bar'})
+        channels = [foo, bar]
+        assert layer.receive(channels) == (foo, {'hey': 'there'})
+        assert layer.receive(channels) == (bar, {'foo': 'bar'})
+        assert layer.receive(channels) == (None, None)
+        with pytest.raises(ValueError):
+            self.channel_layer_cls(self.amqp_url, ack_policy='unknown')
+
+    def test_receive_scheduler(self):
+        """Receive scheduler policies choose channel with message."""
+
+        channels = ['foo', 'bar', 'baz']
+        scheduler = ReceiveScheduler('ordered')
+        assert scheduler.choose(channels, ['bar', 'baz']) == 'bar'
+        scheduler = ReceiveScheduler('round-robin')
+        assert scheduler.choose(channels, ['foo', 'baz']) == 'foo'
+        assert scheduler.choose(channels, ['foo', 'baz']) == 'baz'
+        assert scheduler.choose(channels, ['foo', 'baz']) == 'foo'
+        priorities = self.channel_layer.compile_capacities({'ba*': 3})
+        scheduler = ReceiveScheduler('weighted', priorities)
+        chosen = [scheduler.choose(channels, channels) for _ in range(7)]
+        assert chosen.count('foo') == 1
+        assert chosen.count('bar') == 3
+        assert chosen.count('baz') == 3
+        scheduler = ReceiveScheduler('priority', priorities)
+        assert scheduler.choose(channels, ['foo', 'baz']) == 'baz'
+        # Inbox rotation continues after the last chosen channel even
+        # if it has no message now.
+        protocol = Protocol(1, 5, self.channel_layer.get_capacity, None,
+                            None, receive_policy='round-robin')
+        protocol.scheduler.last = 'bar'
+        protocol.inbox.extend([
+            (None, 'foo', 'foo', b'foo'),
+            (None, 'baz', 'baz', b'baz'),
+        ])
+        assert protocol.take_inbox(channels) == ('baz', b'baz')
+
+    def test_round_robin_receive(self):
+        """Busy first channel doesn't starve other channels."""
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            receive_policy='round-robin',
+        )
+        foo = layer.new_channel('rr.foo?')
+        bar = layer.new_channel('rr.bar?')
+        for number in range(2):
+            layer.send(foo, {'number': number})
+            layer.send(bar, {'number': number})
+        channels = [foo, bar]
+        received = [layer.receive(channels)[0] for _ in range(4)]
+        assert received == [foo, bar, foo, bar]
+        with pytest.raises(ValueError):
+            self.channel_layer_cls(self.amqp_url, receive_policy='unknown')
+
+    def test_receive_batch(self):
+        """Receive many messages in one call."""
+
+        foo = self.channel_layer.new_channel('rb.foo?')
+        bar = self.channel_layer.new_channel('rb.bar?')
+        for number in range(5):
+            self.channel_layer.send(foo, {'number': number})
+        for number in range(2):
+            self.channel_layer.send(bar, {'number': number})
+        channels = [foo, bar]
+        messages = self.channel_layer.receive_batch(channels, 4)
+        assert len(messages) == 4
+        messages.extend(self.channel_layer.receive_batch(channels, 10))
+        assert len(messages) == 7
+        received = [message for channel, message in messages if channel == foo]
+        assert received == [{'number': number} for number in range(5)]
+        assert self.channel_layer.receive_batch(channels, 10) == []
+        start = time.time()
+        assert self.channel_layer.receive_batch(channels, 10, 0.2) == []
+        assert time.time() - start >= 0.2
+        self.channel_layer.send(bar, {'hey': 'there'})
+        assert self.channel_layer.receive_batch(channels, 10, 0.2) == [
+            (bar, {'hey': 'there'})]
+
+    def test_receive_batch_policy(self):
+        """
+        Every channel is polled in the batch receive.  Receive policy
+        chooses which messages to keep.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            receive_policy='priority',
+            channel_priority={'rbp.bar?*': 2},
+        )
+        foo = layer.new_channel('rbp.foo?')
+        bar = layer.new_channel('rbp.bar?')
+        layer.send(foo, {'foo': 1})
+        layer.send(bar, {'bar': 1})
+        assert layer.receive_batch([foo, bar], 1) == [(bar, {'bar': 1})]
+        assert layer.receive_batch([foo, bar], 1) == [(foo, {'foo': 1})]
+        assert layer.receive_batch([foo, bar], 1) == []
+
+    def test_receive_timeout(self):
+        """
+        Blocking receive returns empty response on timeout.  Consumers
+        are canceled and channel can be used further.
+        """
+
+        name = self.channel_layer.new_channel('rt.foo?')
+        time.sleep(0.5)  # Let event loop wait in poll.
+        start = time.time()
+        assert self.channel_layer.receive([name], block=True,
+                                          timeout=0.2) == (None, None)
+        assert 0.2 <= time.time() - start < 1
+        protocol = self.channel_layer.thread.connection.thread_protocol
+        assert not protocol.blocking
+        self.channel_layer.send(name, {'hey': 'there'})
+        assert self.channel_layer.receive([name], block=True,
+                                          timeout=0.2) == (
+            name, {'hey': 'there'})
+        assert protocol is self.channel_layer.thread.connection.thread_protocol
+
+    def test_layer_timeout(self):
+        """Layer timeout is used by default."""
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            prefetch_count=1,
+            timeout=0.2,
+        )
+        name = layer.new_channel('lt.foo?')
+        assert layer.receive([name], block=True) == (None, None)
+        layer.send(name, {'hey': 'there'})
+        assert layer.receive([name], block=True) == (name, {'hey': 'there'})
+        start = time.time()
+        assert layer.receive_batch([name], 10, 0.5) == []
+        assert time.time() - start >= 0.5
+
+    def test_chunks_buffer(self):
+        """Chunks of the message can be received in any order."""
+
+        chunks = Chunks()
+        assert chunks.add('a', 1, 3, b'b', 10) is None
+        assert chunks.add('b', 0, 2, b'x', 10) is None
+        assert chunks.add('a', 0, 3, b'a', 10) is None
+        assert chunks.add('a', 2, 3, b'c', 10) == b'abc'
+        assert list(chunks.messages.data) == ['b']
+
+    def test_binary_message_body(self):
+        """
+        Message body is decoded in one pass.  Binary fields stay bytes,
+        string fields become text.
+        """
+
+        name = self.channel_layer.new_channel('bin.foo?')
+        message = {'body': b'\x00\xff' * 1000, 'path': u'/caf\xe9/'}
+        self.channel_layer.send(name, message)
+        channel, received = self.channel_layer.receive([name])
+        assert received == message
+        assert isinstance(received['body'], bytes)
+        assert isinstance(received['path'], type(u''))
+
+    def test_pipelined_group_add(self):
+        """
+        Pipelined group add declares topology without waiting for each
+        reply.  Membership known to be in place is only renewed.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            pipeline_group_add=True,
+        )
+        name = layer.new_channel('pg.foo?')
+        bar = layer.new_channel('pg.bar?')
+        layer.group_add('pg_test', name)
+        layer.group_add('pg_test', bar)
+        bindings = layer.thread.connection.topology.bindings
+        assert ('pg_test', name, None) in bindings
+        layer.group_add('pg_test', name)
+        layer.send_group('pg_test', {'hey': 'there'})
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+        assert layer.receive([bar]) == (bar, {'hey': 'there'})
+        layer.group_discard('pg_test', name)
+        assert ('pg_test', name, None) not in bindings
+        layer.send_group('pg_test', {'hey': 'there'})
+        assert layer.receive([name]) == (None, None)
+
+    def test_empty_group_cache(self):
+        """
+        Group without members returns message.  Next sends to this group
+        are skipped until group add.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            empty_group_ttl=10,
+        )
+        layer.send_group('eg_test', {'hey': 'there'})
+        time.sleep(0.1)
+        empty_groups = layer.thread.connection.topology.empty_groups
+        assert 'eg_test' in empty_groups
+        layer.send_group('eg_test', {'hey': 'there'})
+        name = layer.new_channel('eg.foo?')
+        layer.group_add('eg_test', name)
+        assert 'eg_test' not in empty_groups
+        layer.send_group('eg_test', {'hey': 'there'})
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+        assert 'eg_test' not in empty_groups
+
+    def test_group_add_many(self):
+        """
+        Many channels can be added to many groups and removed from them
+        in one call.
+        """
+
+        name = self.channel_layer.new_channel('gm.foo?')
+        other = self.channel_layer.new_channel('gm.other?')
+        local = 'gm.bar!baz'
+        self.channel_layer.group_add_many([
+            ('gm_one', name),
+            ('gm_two', name),
+            ('gm_one', other),
+            ('gm_two', local),
+        ])
+        self.channel_layer.send_group('gm_one', {'group': 'one'})
+        self.channel_layer.send_group('gm_two', {'group': 'two'})
+        time.sleep(0.2)  # Give dead letters time to work.
+        assert self.channel_layer.receive([name]) == (name, {'group': 'one'})
+        assert self.channel_layer.receive([name]) == (name, {'group': 'two'})
+        assert self.channel_layer.receive([other]) == (
+            other, {'group': 'one'})
+        assert self.channel_layer.receive(['gm.bar!']) == (
+            local, {'group': 'two'})
+        self.channel_layer.group_discard_many([
+            ('gm_one', name),
+            ('gm_two', local),
+        ])
+        self.channel_layer.send_group('gm_one', {'group': 'one'})
+        self.channel_layer.send_group('gm_two', {'group': 'two'})
+        time.sleep(0.2)
+        assert self.channel_layer.receive([name]) == (name, {'group': 'two'})
+        assert self.channel_layer.receive([name]) == (None, None)
+        assert self.channel_layer.receive(['gm.bar!']) == (None, None)
+
+    def test_group_expiry_buckets(self):
+        """
+        Memberships expire in time buckets.  Member added again keeps
+        its membership when previous bucket expires.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=2,
+            capacity=self.capacity_limit,
+            group_expiry_buckets=2,
+        )
+        name = layer.new_channel('geb.foo?')
+        bar = layer.new_channel('geb.bar?')
+        layer.group_add('geb_test', name)
+        layer.group_add('geb_test', bar)
+        time.sleep(1.5)
+        layer.group_add('geb_test', name)
+        time.sleep(2)  # First bucket expires.
+        layer.send_group('geb_test', {'hey': 'there'})
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+        assert layer.receive([bar]) == (None, None)
+        layer.group_discard('geb_test', name)
+        layer.send_group('geb_test', {'hey': 'there'})
+        assert layer.receive([name]) == (None, None)
+        with pytest.raises(ValueError):
+            self.channel_layer_cls(self.amqp_url, group_expiry_buckets=61)
+
+    def test_pipelined_group_expiry_buckets(self):
+        """
+        Pipelined group add binds member known to be in place again
+        when its expiry bucket changes.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=2,
+            capacity=self.capacity_limit,
+            group_expiry_buckets=2,
+            pipeline_group_add=True,
+        )
+        name = layer.new_channel('pgb.foo?')
+        layer.group_add('pgb_test', name)
+        time.sleep(1.5)
+        layer.group_add('pgb_test', name)
+        bindings = layer.thread.connection.topology.bindings
+        buckets = set(key[2] for key in bindings.data
+                      if key[:2] == ('pgb_test', name))
+        assert len(buckets) == 2
+        time.sleep(2)  # First bucket expires.
+        layer.send_group('pgb_test', {'hey': 'there'})
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+
+    def test_group_refresh_window(self):
+        """
+        Group add of the member added within refresh window does
+        nothing.  Discard forgets the member.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            group_refresh_window=2,
+        )
+        name = layer.new_channel('grw.foo?')
+        layer.group_add('grw_test', name)
+        refreshed = layer.thread.connection.topology.refreshed
+        assert ('grw_test', name) in refreshed
+        layer.group_add('grw_test', name)
+        layer.send_group('grw_test', {'hey': 'there'})
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+        layer.group_discard('grw_test', name)
+        assert ('grw_test', name) not in refreshed
+        layer.group_add('grw_test', name)
+        layer.send_group('grw_test', {'hey': 'there'})
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+        with pytest.raises(ValueError):
+            self.channel_layer_cls(self.amqp_url, group_expiry=5,
+                                   group_refresh_window=5)
+
+    def test_direct_local_groups(self):
+        """
+        Group message is routed to the process local queue by the
+        broker.  Receive restores local part of the channel name.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            direct_local_groups=True,
+        )
+        layer.receive(['dlg.foo!'])
+        layer.group_add('dlg_test', 'dlg.foo!bar')
+        layer.group_add('dlg_test', 'dlg.foo!baz')
+        layer.send_group('dlg_test', {'hey': 'there'})
+        time.sleep(0.1)
+        received = set(
+            layer.receive(['dlg.foo!'])[0] for _ in range(2)
+        )
+        assert received == {'dlg.foo!bar', 'dlg.foo!baz'}
+        assert layer.receive(['dlg.foo!']) == (None, None)
+
+    def test_direct_local_groups_message_expiry(self):
+        """
+        Group message routed to the process local queue by the broker
+        expires there.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            direct_local_groups=True,
+        )
+        layer.receive(['dle.foo!'])
+        layer.group_add('dle_test', 'dle.foo!bar')
+        layer.send_group('dle_test', {'hey': 'there'})
+        time.sleep(1.5)
+        assert layer.receive(['dle.foo!']) == (None, None)
+
+    def test_direct_group_routing(self):
+        """
+        Groups can route messages by routing key of the shared exchange
+        without intermediate exchange for each member.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            group_routing='direct',
+        )
+        name = layer.new_channel('dgr.foo?')
+        layer.group_add('dgr_one', name)
+        layer.group_add('dgr_two', name)
+        layer.group_add('dgr_two', 'dgr.bar!baz')
+        layer.send_group('dgr_one', {'group': 'one'})
+        layer.send_group('dgr_two', {'group': 'two'})
+        time.sleep(0.2)  # Give dead letters time to work.
+        assert layer.receive([name]) == (name, {'group': 'one'})
+        assert layer.receive([name]) == (name, {'group': 'two'})
+        assert layer.receive(['dgr.bar!']) == ('dgr.bar!baz',
+                                               {'group': 'two'})
+        assert name not in self.defined_exchanges
+        assert 'dgr_one' not in self.defined_exchanges
+        layer.group_discard('dgr_two', name)
+        layer.send_group('dgr_two', {'group': 'two'})
+        assert layer.receive([name]) == (None, None)
+        with pytest.raises(ValueError):
+            self.channel_layer_cls(self.amqp_url, group_routing='unknown')
+
+    def test_direct_group_routing_message_expiry(self):
+        """
+        Expired message doesn't remove single reader channel queue in
+        the direct routing mode.  Other messages and memberships stay.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            group_routing='direct',
+        )
+        name = layer.new_channel('dge.foo?')
+        layer.group_add('dge_test', name)
+        layer.send(name, {'n': 1})
+        time.sleep(0.7)
+        layer.send(name, {'n': 2})
+        time.sleep(0.7)  # First message expires.
+        assert layer.receive([name]) == (name, {'n': 2})
+        layer.send_group('dge_test', {'hey': 'there'})
+        assert layer.receive([name]) == (name, {'hey': 'there'})
+
+    def test_known_queue_capacity(self):
+        """
+        Queue length we remember can be bigger than real one.  Ask broker
+        before raising ChannelFull.
+        """
+
+        name = self.channel_layer.new_channel('kq.foo?')
+        for _ in range(self.capacity_limit):
+            self.channel_layer.send(name, {'bar': 'baz'})
+        self.channel_layer.receive([name])
+        self.channel_layer.send(name, {'bar': 'baz'})
+        with pytest.raises(self.channel_layer.ChannelFull):
+            self.channel_layer.send(name, {'bar': 'baz'})
+
 
 @pytest.mark.local
 class RabbitmqLocalChannelLayerTest(RabbitmqChannelLayerTest):
@@ -577,6 +1479,23 @@ class RabbitmqLocalChannelLayerTest(RabbitmqChannelLayerTest):
         self.channel_layer.send(name, {'bar': 'baz'})
         assert name in self.defined_queues
 
+    def test_receive_batch_mixed_channels(self):
+        """
+        Batch receive from local and remote channels waits for the first
+        message up to timeout.
+        """
+
+        name = self.channel_layer.new_channel('rbm.foo?')
+        channels = ['rbm.bar', name]
+        start = time.time()
+        assert self.channel_layer.receive_batch(channels, 10, 0.3) == []
+        assert time.time() - start >= 0.3
+        self.channel_layer.send('rbm.bar', {'local': 1})
+        self.channel_layer.send(name, {'remote': 1})
+        messages = self.channel_layer.receive_batch(channels, 10, 0.3)
+        assert sorted(messages, key=repr) == [
+            ('rbm.bar', {'local': 1}), (name, {'remote': 1})]
+
     def test_groups(self):
         """
         Tests that basic group addition and send works.  We need to use
@@ -607,6 +1526,172 @@ class RabbitmqLocalChannelLayerTest(RabbitmqChannelLayerTest):
         assert message is None
 
 
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='asyncio layer requires Python 3.5')
+class RabbitmqAsyncChannelLayerTest(SetupMixin, RabbitmqLayerTestCaseMixin,
+                                    SimpleTestCase):
+
+    def setUp(self):
+
+        import asyncio
+        from asgi_rabbitmq.aio import RabbitmqAsyncChannelLayer
+        self.channel_layer_cls = RabbitmqAsyncChannelLayer
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        super(RabbitmqAsyncChannelLayerTest, self).setUp()
+
+    def tearDown(self):
+
+        self.loop.close()
+        super(RabbitmqAsyncChannelLayerTest, self).tearDown()
+
+    def wait(self, coroutine):
+        """Run coroutine in the test event loop."""
+
+        return self.loop.run_until_complete(coroutine)
+
+    def test_send_receive(self):
+        """Layer methods are coroutines."""
+
+        name = self.wait(self.channel_layer.new_channel('aio.foo?'))
+        self.wait(self.channel_layer.send(name, {'hey': 'there'}))
+        assert self.wait(self.channel_layer.receive([name])) == (
+            name, {'hey': 'there'})
+        assert self.wait(self.channel_layer.receive([name])) == (None, None)
+
+    def test_concurrent_receive(self):
+        """Many blocking receives can wait in one event loop."""
+
+        import asyncio
+        receives = asyncio.ensure_future(asyncio.gather(
+            self.channel_layer.receive(['aio.foo'], block=True),
+            self.channel_layer.receive(['aio.bar'], block=True),
+            loop=self.loop,
+        ), loop=self.loop)
+        self.wait(self.channel_layer.send('aio.bar', {'bar': 1}))
+        self.wait(self.channel_layer.send('aio.foo', {'foo': 1}))
+        assert self.wait(receives) == [
+            ('aio.foo', {'foo': 1}),
+            ('aio.bar', {'bar': 1}),
+        ]
+
+    def test_groups(self):
+        """Group methods are coroutines."""
+
+        name = self.wait(self.channel_layer.new_channel('aio.foo?'))
+        self.wait(self.channel_layer.group_add('aio.group', name))
+        self.wait(self.channel_layer.send_group('aio.group', {'foo': 'bar'}))
+        assert self.wait(self.channel_layer.receive([name])) == (
+            name, {'foo': 'bar'})
+        self.wait(self.channel_layer.group_discard('aio.group', name))
+        self.wait(self.channel_layer.send_group('aio.group', {'foo': 'bar'}))
+        assert self.wait(self.channel_layer.receive([name])) == (None, None)
+
+    def test_cancelled_receive(self):
+        """
+        Cancelled blocking receive stops its consumers before the AMQP
+        channel returns to the pool.  Next message isn't lost.
+        """
+
+        import asyncio
+        with pytest.raises(asyncio.TimeoutError):
+            self.wait(asyncio.wait_for(
+                self.channel_layer.receive(['aio.foo'], block=True),
+                0.1,
+            ))
+        connection = self.channel_layer.thread.connection
+        time.sleep(0.1)
+        assert not connection.in_flight
+        assert all(not protocol.blocking for protocol in connection.pool)
+        self.wait(self.channel_layer.send('aio.foo', {'foo': 1}))
+        assert self.wait(self.channel_layer.receive(
+            ['aio.foo'], block=True)) == ('aio.foo', {'foo': 1})
+
+    def test_connection_close_notify_pooled_futures(self):
+        """
+        Methods in progress on pooled AMQP channels are notified about
+        closed connection.
+        """
+
+        from asgi_rabbitmq.core import RECEIVE
+        connection = self.channel_layer.thread.connection
+        while not connection.connection.is_open:
+            time.sleep(0.5)
+        future = self.channel_layer.thread.pool_schedule(
+            RECEIVE, ['aio.foo'], True)
+        time.sleep(0.1)
+        connection.connection.close()
+        with pytest.raises(ConnectionClosed):
+            future.result()
+
+    def test_pooled_consumers(self):
+        """
+        Pooled AMQP channels keep persistent consumers.  Receive takes
+        channel consuming the same channels.  Receive from other
+        channels cancels them and returns their messages to the queue.
+        """
+
+        layer = self.channel_layer_cls(
+            self.amqp_url,
+            expiry=1,
+            group_expiry=5,
+            capacity=self.capacity_limit,
+            prefetch_count=10,
+        )
+        self.wait(layer.send('aio.foo', {'foo': 1}))
+        self.wait(layer.send('aio.foo', {'foo': 2}))
+        assert self.wait(layer.receive(['aio.foo'], block=True)) == (
+            'aio.foo', {'foo': 1})
+        connection = layer.thread.connection
+        time.sleep(0.1)
+        pool = list(connection.pool)
+        assert [list(protocol.consumers) for protocol in pool] == [
+            ['aio.foo']]
+        assert self.wait(layer.receive(['aio.foo'], block=True)) == (
+            'aio.foo', {'foo': 2})
+        time.sleep(0.1)
+        assert connection.pool == pool
+        self.wait(layer.send('aio.foo', {'foo': 3}))
+        time.sleep(0.1)
+        assert self.wait(layer.receive(['aio.bar'], block=True,
+                                       timeout=0.1)) == (None, None)
+        time.sleep(0.1)
+        assert not pool[0].consumers
+        assert not pool[0].inbox
+        assert self.wait(layer.receive(['aio.foo'])) == (
+            'aio.foo', {'foo': 3})
+
+    def test_cancelled_send(self):
+        """
+        Cancelled send doesn't break connection thread.  Message is
+        sent anyway.
+        """
+
+        import asyncio
+        task = asyncio.ensure_future(
+            self.channel_layer.send('aio.foo', {'foo': 1}), loop=self.loop)
+        self.wait(asyncio.sleep(0))  # Let the task schedule the send.
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            self.wait(task)
+        time.sleep(0.1)
+        assert self.channel_layer.thread.is_alive()
+        assert self.wait(self.channel_layer.receive(
+            ['aio.foo'], block=True)) == ('aio.foo', {'foo': 1})
+
+    def test_batch_methods(self):
+        """Batch methods are coroutines too."""
+
+        self.wait(self.channel_layer.send_many([
+            ('aio.foo', {'foo': 1}),
+            ('aio.foo', {'foo': 2}),
+        ]))
+        assert self.wait(self.channel_layer.receive_batch(['aio.foo'])) == [
+            ('aio.foo', {'foo': 1}),
+            ('aio.foo', {'foo': 2}),
+        ]
+
+
 class InheritanceTest(TestCase):
 
     def test_mixin_inheritance_verification(self):
@@ -666,6 +1751,33 @@ class RabbitmqChannelLayerTwistedTest(SetupMixin, RabbitmqLayerTestCaseMixin,
         self.assertEqual(channel, "sr_test2")
         self.assertEqual(message, {"value": "red"})
 
+    @defer.inlineCallbacks
+    def test_receive_pool(self):
+        """Twisted receive reuses AMQP channels of the bounded pool."""
+
+        connection = self.channel_layer.thread.connection
+        self.channel_layer.send("tp_test", {"value": "blue"})
+        self.channel_layer.send("tp_test", {"value": "green"})
+        channel, message = yield self.channel_layer.receive_twisted(
+            ["tp_test"])
+        self.assertEqual(message, {"value": "blue"})
+        self.assertEqual(len(connection.pool), 1)
+        protocol = connection.pool[0]
+        channel, message = yield self.channel_layer.receive_twisted(
+            ["tp_test"])
+        self.assertEqual(message, {"value": "green"})
+        self.assertEqual(connection.pool, [protocol])
+        # Channels over the pool size are closed.
+        deferreds = [
+            self.channel_layer.receive_twisted(["tp_test"])
+            for _ in range(connection.pool_size + 2)
+        ]
+        for number in range(len(deferreds)):
+            self.channel_layer.send("tp_test", {"value": number})
+        yield defer.gatherResults(deferreds)
+        self.assertEqual(len(connection.pool),
+                         connection.pool_size)
+
 
 @pytest.mark.twisted
 @pytest.mark.local